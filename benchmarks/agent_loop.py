@@ -0,0 +1,60 @@
+"""Measure the overhead of the Agent loop per turn, with a fake OpenAI client and stub tools that return at once.
+
+Usage: python benchmarks/agent_loop.py [--conversations 500] [--tool-turns 3] [--tool-calls 2] [--tools 60]
+"""
+import argparse
+import json
+import time
+
+import interfaces_to as into
+from interfaces_to.bases import ToolRegistry
+
+from fakes import FakeOpenAI, make_tool_set
+
+
+def conversations(registry, client, count, **agent_args):
+    """Run count conversations and return the seconds per turn"""
+    start = time.perf_counter()
+    calls = client.calls
+    for _ in range(count):
+        agent = into.Agent(verbose=False, **agent_args).add_messages("Start")
+        agent.tools = registry
+        while agent:
+            agent.completion = client.chat.completions.create(messages=agent.messages, tools=agent.tools)
+    return (time.perf_counter() - start) / (client.calls - calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--conversations', type=int, default=500)
+    parser.add_argument('--tool-turns', type=int, default=3)
+    parser.add_argument('--tool-calls', type=int, default=2, help='Tool calls in each turn')
+    parser.add_argument('--tools', type=int, default=60)
+    args = parser.parse_args()
+
+    registry = ToolRegistry(make_tool_set(args.tools)())
+    tool_names = [f"stub_{i}" for i in range(args.tools)]
+
+    def client():
+        return FakeOpenAI(tool_names, tool_turns=args.tool_turns, tool_calls_per_turn=args.tool_calls)
+
+    # warm up, so the first measurement isn't slower for it
+    conversations(registry, client(), 10)
+
+    results = {
+        "conversations": args.conversations,
+        "turns_per_conversation": args.tool_turns + 1,
+        "tool_calls_per_turn": args.tool_calls,
+        "tools": args.tools,
+        "us_per_turn": conversations(registry, client(), args.conversations) * 1e6,
+        "parallel_us_per_turn": conversations(registry, client(), args.conversations,
+                                              parallel_tool_calls=True) * 1e6,
+        # with a hook that does nothing, to show the cost of collecting spans
+        "traced_us_per_turn": conversations(registry, client(), args.conversations,
+                                            hooks=[lambda span: None]) * 1e6,
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
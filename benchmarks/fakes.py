@@ -0,0 +1,83 @@
+"""Stand-ins for the OpenAI client and tools, so the benchmarks measure into itself and not the network."""
+import itertools
+import json
+import time
+from types import SimpleNamespace
+
+from interfaces_to.bases import FunctionSet
+from interfaces_to.utils import callable_function
+
+
+def make_function(name, latency=0.0):
+    def function(self, value: str = ""):
+        if latency:
+            time.sleep(latency)
+        return value
+
+    function.__name__ = name
+    function.__doc__ = f"""
+    Stub function {name}
+
+    :param value: The value to return
+    """
+    return callable_function(function)
+
+
+def make_tool_set(count, latency=0.0, name="Stub"):
+    """A FunctionSet class with count stub functions, each sleeping for latency seconds"""
+    functions = {f"stub_{i}": make_function(f"stub_{i}", latency) for i in range(count)}
+    return type(name, (FunctionSet,), functions)
+
+
+def tool_call(id, name, arguments='{"value": "ok"}'):
+    return SimpleNamespace(id=id, type="function",
+                           function=SimpleNamespace(name=name, arguments=arguments))
+
+
+def make_completion(content=None, tool_calls=None, model="fake"):
+    usage = SimpleNamespace(prompt_tokens=0, completion_tokens=0)
+    return SimpleNamespace(model=model, usage=usage, choices=[SimpleNamespace(
+        index=0, message=SimpleNamespace(content=content, tool_calls=tool_calls))])
+
+
+class FakeOpenAI:
+    """A scripted client with the shape of openai.OpenAI. Each turn of a conversation answers with
+    tool_calls_per_turn calls of the named tools, and every tool_turns + 1th turn with a plain reply.
+    latency seconds are spent on each completion, as if waiting for the API"""
+
+    def __init__(self, tool_names=("stub_0",), tool_turns=1, tool_calls_per_turn=1, latency=0.0):
+        self.tool_names = itertools.cycle(tool_names)
+        self.tool_turns = tool_turns
+        self.tool_calls_per_turn = tool_calls_per_turn
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, messages=None, tools=None, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        # count the tool turns since the last user message
+        tool_turns = 0
+        for message in reversed(messages or []):
+            if message["role"] == "user":
+                break
+            if message["role"] == "assistant" and message.get("tool_calls"):
+                tool_turns += 1
+
+        if tool_turns >= self.tool_turns:
+            return make_completion(content="done")
+        return make_completion(tool_calls=[
+            tool_call(f"call_{self.calls}_{i}", next(self.tool_names)) for i in range(self.tool_calls_per_turn)])
+
+
+def history(length):
+    """A conversation of length messages, as earlier turns of tool calls and their results"""
+    messages = [{"role": "user", "content": "Start"}]
+    while len(messages) < length:
+        id = f"call_{len(messages)}"
+        messages.append({"role": "assistant", "content": None, "tool_calls": [
+            {"id": id, "type": "function", "function": {"name": "stub_0", "arguments": json.dumps({"value": "ok"})}}]})
+        messages.append({"role": "tool", "tool_call_id": id, "name": "stub_0", "content": "ok " * 50})
+    return messages[:length]
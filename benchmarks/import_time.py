@@ -0,0 +1,66 @@
+"""Measure the startup cost of `import interfaces_to` with `python -X importtime`.
+
+Usage: python benchmarks/import_time.py [--runs 5] [--access Self] [--max-ms 500]
+
+Exits with status 1 if the median import time is above --max-ms, or if pkg_resources is
+imported, so it can be used to guard against startup regressions.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+def import_time(statement):
+    """Run statement in a fresh interpreter and return {module: (self_us, cumulative_us)}"""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True, text=True, check=True)
+
+    modules = {}
+    for line in process.stderr.splitlines():
+        # import time:  self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--access', default=None,
+                        help='Also load a lazily imported tool, e.g. Self, to include its dependency check')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Fail if the median import time is above this many milliseconds')
+    args = parser.parse_args()
+
+    statement = "import interfaces_to"
+    if args.access:
+        statement += f"; interfaces_to.{args.access}.__name__"
+
+    runs = [import_time(statement) for _ in range(args.runs)]
+    totals = [sum(self_us for self_us, _ in modules.values()) / 1000 for modules in runs]
+    slowest = sorted(runs[-1].items(), key=lambda item: item[1][0], reverse=True)[:10]
+
+    results = {
+        "statement": statement,
+        "runs": args.runs,
+        "median_ms": statistics.median(totals),
+        "min_ms": min(totals),
+        "interfaces_to_ms": runs[-1].get("interfaces_to", (0, 0))[1] / 1000,
+        "pkg_resources_imported": any("pkg_resources" in modules for modules in runs),
+        "slowest_modules_ms": {name: self_us / 1000 for name, (self_us, _) in slowest},
+    }
+    print(json.dumps(results, indent=2))
+
+    if results["pkg_resources_imported"]:
+        sys.exit("pkg_resources was imported at startup")
+    if args.max_ms is not None and results["median_ms"] > args.max_ms:
+        sys.exit(f"median import time {results['median_ms']:.1f}ms is above {args.max_ms}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Measure how long it takes to create FunctionSets and ToolRegistries.
+
+Usage: python benchmarks/instantiation.py [--functions 10,60,200] [--repeat 2000]
+"""
+import argparse
+import json
+import time
+
+import interfaces_to as into
+from interfaces_to.bases import ToolRegistry
+
+from fakes import make_tool_set
+
+
+def timed(create, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        create()
+    return (time.perf_counter() - start) / repeat
+
+
+def integers(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--functions', type=integers, default=[10, 60, 200])
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    by_functions = []
+    for count in args.functions:
+        tool_set = make_tool_set(count)
+        by_functions.append({
+            "functions": count,
+            "function_set_us": timed(tool_set, args.repeat) * 1e6,
+            "registry_us": timed(lambda: ToolRegistry(tool_set()), args.repeat) * 1e6,
+        })
+
+    results = {
+        "repeat": args.repeat,
+        "by_functions": by_functions,
+        # the tools that have no dependencies, as created by add_tools
+        "import_tools_us": timed(lambda: into.import_tools(["System"]), args.repeat) * 1e6,
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
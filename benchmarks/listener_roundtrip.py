@@ -0,0 +1,129 @@
+"""Measure the round trip of a message through a listener: from put_message until the listener receives the
+assistant's reply, for the Agent loop and for a Runtime. The client and tools are fakes that return at once.
+
+Usage: python benchmarks/listener_roundtrip.py [--messages 500] [--tool-turns 1] [--sessions 8]
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+
+import interfaces_to as into
+from interfaces_to.bases import Messages, MessageQueue, ToolRegistry
+
+from fakes import FakeOpenAI, make_tool_set
+
+
+class LocalListener(MessageQueue):
+    """A listener without a server, which records when each session receives a reply"""
+
+    def __init__(self):
+        self.replied = {}
+        super().__init__()
+
+    def client_thread(self):
+        pass
+
+    def receive_message(self, message, session=None):
+        if message["role"] == "assistant" and not message.get("tool_calls"):
+            self.replied[session].set()
+
+    def round_trip(self, session):
+        self.replied[session] = threading.Event()
+        start = time.perf_counter()
+        self.put_message({"role": "user", "content": "Start"}, session=session)
+        self.replied[session].wait()
+        return time.perf_counter() - start
+
+    def stop(self):
+        self.exit_event.set()
+        self.multiplexer.notify()
+
+
+def summary(seconds):
+    seconds = sorted(seconds)
+    return {
+        "median_us": statistics.median(seconds) * 1e6,
+        "p95_us": seconds[int(len(seconds) * 0.95) - 1] * 1e6,
+        "max_us": seconds[-1] * 1e6,
+    }
+
+
+def agent_round_trips(registry, client, count):
+    listener = LocalListener()
+    messages = Messages(listeners=[listener])
+
+    def loop():
+        agent = into.Agent(verbose=False).add_messages(messages)
+        agent.tools = registry
+        while agent:
+            agent.completion = client.chat.completions.create(messages=agent.messages, tools=agent.tools)
+
+    thread = threading.Thread(target=loop)
+    thread.start()
+    try:
+        return [listener.round_trip(f"session_{i}") for i in range(count)]
+    finally:
+        listener.stop()
+        thread.join()
+
+
+def runtime_round_trips(registry, client, count, sessions):
+    listener = LocalListener()
+    runtime = into.Runtime(Messages(listeners=[listener]), tools=registry, workers=sessions,
+                           complete=lambda messages, tools: client.chat.completions.create(messages=messages, tools=tools))
+    thread = threading.Thread(target=runtime.run_forever)
+    thread.start()
+
+    seconds = []
+    lock = threading.Lock()
+
+    def send(session, count):
+        for _ in range(count):
+            round_trip = listener.round_trip(session)
+            with lock:
+                seconds.append(round_trip)
+
+    # each session sends its messages one after another, while the sessions run at once
+    senders = [threading.Thread(target=send, args=(f"session_{i}", count // sessions)) for i in range(sessions)]
+    start = time.perf_counter()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    elapsed = time.perf_counter() - start
+
+    listener.stop()
+    thread.join()
+    return seconds, len(seconds) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--tool-turns', type=int, default=1)
+    parser.add_argument('--sessions', type=int, default=8, help='Concurrent sessions for the Runtime')
+    args = parser.parse_args()
+
+    registry = ToolRegistry(make_tool_set(10)())
+
+    def client():
+        return FakeOpenAI(tool_turns=args.tool_turns)
+
+    runtime_seconds, messages_per_second = runtime_round_trips(registry, client(), args.messages, args.sessions)
+    results = {
+        "messages": args.messages,
+        "tool_turns": args.tool_turns,
+        "agent": summary(agent_round_trips(registry, client(), args.messages)),
+        "runtime": {
+            "sessions": args.sessions,
+            "messages_per_second": messages_per_second,
+            **summary(runtime_seconds),
+        },
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Run every benchmark and write their results to one JSON file, optionally comparing them with an earlier run.
+
+Usage: python benchmarks/run_all.py [--output results.json] [--compare previous.json] [--threshold 1.2]
+
+Exits with status 1 if --compare is given and a timing is more than --threshold times its earlier value.
+"""
+import argparse
+import importlib.metadata
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+BENCHMARKS = ["run_overhead", "agent_loop", "instantiation", "listener_roundtrip", "import_time"]
+
+# lower is better for these results, and they are compared between runs
+TIMINGS = ("_us", "_ms", "_us_per_turn")
+
+
+def run_benchmark(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{name}.py")
+    process = subprocess.run([sys.executable, path], capture_output=True, text=True)
+    if process.returncode != 0 and not process.stdout.strip():
+        return {"error": process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "failed"}
+    return json.loads(process.stdout)
+
+
+def flatten(results, prefix=""):
+    """Flatten nested results into {"agent_loop.us_per_turn": 12.3, "run_overhead.by_tools[60].list_us_per_turn": ...}"""
+    flat = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            flat.update(flatten(value, f"{prefix}.{key}" if prefix else key))
+    elif isinstance(results, list):
+        for item in results:
+            # name the items of a sweep by their first value, e.g. the number of tools
+            label = next(iter(item.values())) if isinstance(item, dict) and item else results.index(item)
+            flat.update(flatten(item, f"{prefix}[{label}]"))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        flat[prefix] = results
+    return flat
+
+
+def compare(current, previous, threshold):
+    """Return the timings that got slower than threshold times their earlier value"""
+    current, previous = flatten(current), flatten(previous)
+    regressions = {}
+    for key, value in current.items():
+        if key.startswith("environment") or not key.endswith(TIMINGS) or not previous.get(key):
+            continue
+        ratio = value / previous[key]
+        if ratio > threshold:
+            regressions[key] = {"previous": previous[key], "current": value, "ratio": round(ratio, 2)}
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default=None, help='Write the results to this file as well as printing them')
+    parser.add_argument('--compare', default=None, help='The results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    parser.add_argument('--only', default=None, help='Comma separated benchmarks to run, e.g. agent_loop,run_overhead')
+    args = parser.parse_args()
+
+    try:
+        version = importlib.metadata.version("interfaces-to")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+
+    results = {
+        "environment": {
+            "version": version,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+    }
+    for name in (args.only.split(",") if args.only else BENCHMARKS):
+        results[name] = run_benchmark(name)
+
+    if args.compare:
+        with open(args.compare) as f:
+            results["regressions"] = compare(results, json.load(f), args.threshold)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if results.get("regressions"):
+        sys.exit(f"{len(results['regressions'])} timing(s) are more than {args.threshold}x slower")
+
+
+if __name__ == "__main__":
+    main()
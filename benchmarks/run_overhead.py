@@ -0,0 +1,65 @@
+"""Measure the per-turn overhead of into.run() against the number of tools and the length of the history.
+
+Usage: python benchmarks/run_overhead.py [--tools 10,60,200] [--history 0,100,1000] [--turns 2000]
+"""
+import argparse
+import json
+import time
+
+import interfaces_to as into
+from interfaces_to.bases import ToolRegistry, Messages
+
+from fakes import make_tool_set, make_completion, tool_call, history
+
+
+def per_turn(messages, completion, tools, turns, warmup=20):
+    length = len(messages)
+    for turn in range(warmup + turns):
+        if turn == warmup:
+            start = time.perf_counter()
+        into.run(messages, completion, tools)
+        # drop the messages of this turn, so each turn starts with the same history
+        del messages[length:]
+    return (time.perf_counter() - start) / turns
+
+
+def integers(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tools', type=integers, default=[10, 60, 200])
+    parser.add_argument('--history', type=integers, default=[0, 100, 1000])
+    parser.add_argument('--turns', type=int, default=2000)
+    args = parser.parse_args()
+
+    by_tools = []
+    for count in args.tools:
+        functions = list(make_tool_set(count)())
+        completion = make_completion(tool_calls=[tool_call("call_0", f"stub_{count - 1}")])
+        by_tools.append({
+            "tools": count,
+            # a plain list is indexed on every call to run()
+            "list_us_per_turn": per_turn(Messages(), completion, functions, args.turns) * 1e6,
+            # import_tools and Agent.add_tools build the registry once
+            "registry_us_per_turn": per_turn(Messages(), completion, ToolRegistry(functions), args.turns) * 1e6,
+        })
+
+    registry = ToolRegistry(list(make_tool_set(args.tools[0])()))
+    completion = make_completion(tool_calls=[tool_call("call_0", "stub_0")])
+    by_history = [{
+        "history": length,
+        "us_per_turn": per_turn(Messages(history(length)), completion, registry, args.turns) * 1e6,
+    } for length in args.history]
+
+    results = {
+        "turns": args.turns,
+        "by_tools": by_tools,
+        "by_history": by_history,
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
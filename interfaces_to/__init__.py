@@ -2,8 +2,12 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import sys
-from .utils import LazyImport, run, running, import_tools, read_messages
-from .agent import Agent
+from .utils import LazyImport, ResultShaper, run, arun, running, import_tools, read_messages
+from .agent import Agent, AsyncAgent
+from .runtime import Runtime
+from .bases import Messages, MessageQueueFull, ToolCache
+from .tracing import Span, JSONLExporter, OpenTelemetryExporter
+from .journal import Journal
 
 # all tools are imported lazily to avoid hard package dependencies
 tool_classes = [
@@ -14,6 +18,7 @@ tool_classes = [
     ('Notion', '.tools.notion', [('notion-client>=2.2.1')]),
     ('Airtable', '.tools.airtable', []),
     ('PeopleDataLabs', '.tools.peopledatalabs', [('peopledatalabs>=4.0.0')]),
+    ('VectorIndex', '.tools.vectorindex', [('openai>=1.37.1'), ('numpy>=1.24')]),
 ]
 
 # create a module for each tool
@@ -24,5 +29,5 @@ for class_name, location, dependencies in tool_classes:
     setattr(sys.modules[__name__], class_name, LazyImport(location, class_name, dependencies))
 
 # only export what is needed
-__all__ = [class_name for class_name, _, _  in tool_classes] + [run, running, import_tools, read_messages, Agent]
+__all__ = [class_name for class_name, _, _  in tool_classes] + [run, arun, running, import_tools, read_messages, Agent, AsyncAgent, Runtime, Messages, MessageQueueFull, ResultShaper, ToolCache, Span, JSONLExporter, OpenTelemetryExporter, Journal]
 
@@ -1,8 +1,15 @@
-from . import read_messages, import_tools, running, run
-from .bases import Messages
+import asyncio
+import time
+from . import read_messages, import_tools, running, run, arun
+from .bases import Messages, ToolRegistry
+from .utils import render_message, resume_tool_calls
+from .tracing import as_tracer, completion_attributes
+from .journal import Journal
 
 class Agent:
-    def __init__(self, system_message=None, verbose=True):
+    def __init__(self, system_message=None, verbose=True, parallel_tool_calls=False, max_workers=None, tool_timeout=None,
+                 result_shaper=None, max_context_tokens=None, keep_last_turns=4, hooks=None,
+                 journal=None):
         self.tools = None
         self.messages = None
         self.first_run = True
@@ -11,6 +18,21 @@ class Agent:
         self.messages_list = None
         self.system = {"role":"system","content":system_message} if system_message else None
         self.verbose = verbose
+        self.parallel_tool_calls = parallel_tool_calls
+        self.max_workers = max_workers
+        self.tool_timeout = tool_timeout
+        self.result_shaper = result_shaper
+        self.max_context_tokens = max_context_tokens
+        self.keep_last_turns = keep_last_turns
+
+        # hooks are called with a Span for each llm call, tool call, queue wait and rendered message
+        self.tracer = as_tracer(hooks)
+        self.turn = self.tracer
+        self.llm_started = None
+
+        # a path or Journal to write the messages to, and to resume them from after a crash
+        self.journal = Journal(journal) if isinstance(journal, str) else journal
+        self.resumed = False
 
     def add_tools(self, tools_list):
         self.tools_list = tools_list
@@ -30,27 +52,104 @@ class Agent:
         self.messages_list = input
         return self
 
-    def __bool__(self):
+    def close(self):
+        """Close the API clients and connections of the agent's tools, and the journal"""
+        if isinstance(self.tools, ToolRegistry):
+            self.tools.close()
+        if self.journal:
+            self.journal.close()
+
+    def prepare(self):
         if self.messages is None and self.messages_list is not None:
             self.messages = read_messages(self.messages_list)
         if self.tools is None and self.tools_list is not None:
             self.tools = import_tools(self.tools_list)
+        if self.tools is not None and not isinstance(self.tools, ToolRegistry):
+            self.tools = ToolRegistry(self.tools)
 
         if self.first_run and self.system:
             if isinstance(self.messages, Messages):
                 self.messages.system = self.system
             else:
                 self.messages = [self.system] + self.messages
-            
 
-        self.messages = running(self.messages, verbose=self.verbose)
+        # the journal and max_context_tokens need Messages
+        if self.first_run and (self.max_context_tokens or self.journal) and self.messages is not None:
+            if not isinstance(self.messages, Messages):
+                self.messages = Messages(self.messages)
+                if self.verbose and not self.journal:
+                    for message in self.messages:
+                        render_message(message)
+
+        # keep the messages within the context window, see Messages.compact
+        if self.first_run and self.max_context_tokens and self.messages is not None:
+            self.messages.max_tokens = self.max_context_tokens
+            self.messages.keep_last = self.keep_last_turns
+
+        if self.first_run and self.journal and self.messages is not None and self.messages.journal is None:
+            self.open_journal()
+
+        if self.tracer and isinstance(self.messages, Messages) and self.messages.listeners:
+            self.messages.multiplexer.tracer = self.tracer
+
+    def open_journal(self):
+        # a conversation in the journal that was interrupted is resumed instead of starting the given one
+        restored = self.journal.load()
+        finished = not restored or (restored[-1]['role'] == 'assistant' and not restored[-1].get('tool_calls'))
+        if finished:
+            self.journal.clear()
+            self.journal.extend(self.messages)
+        else:
+            self.messages.restore(restored)
+            self.resumed = True
+        self.messages.journal = self.journal
+
+        if self.verbose:
+            for message in self.messages:
+                render_message(message)
+
+    def resume(self):
+        # finish the tool calls that were running when the conversation was interrupted
+        if self.resumed:
+            self.resumed = False
+            self.messages = resume_tool_calls(self.messages, self.tools,
+                                              parallel_tool_calls=self.parallel_tool_calls,
+                                              max_workers=self.max_workers,
+                                              timeout=self.tool_timeout,
+                                              shaper=self.result_shaper,
+                                              results=self.journal.results)
+
+    def start_turn(self):
+        # the llm call is timed from when the agent hands over the messages until the completion is set
+        if self.tracer:
+            self.turn = self.tracer.turn()
+            if isinstance(self.messages, Messages):
+                self.messages.tracer = self.turn
+            self.llm_started = time.perf_counter()
+
+    def trace_completion(self, completion):
+        if self.tracer and self.llm_started is not None:
+            self.turn.record("llm", getattr(completion, "model", None), time.perf_counter() - self.llm_started,
+                             messages=len(self.messages), **completion_attributes(completion))
+            self.llm_started = None
+
+    def should_continue(self):
         if self.completion is None and self.first_run:
             self.first_run = False
             return True
         if not self.messages:
             return False
         return True
-    
+
+    def __bool__(self):
+        self.prepare()
+        self.resume()
+        self.messages = running(self.messages, verbose=self.verbose)
+        if self.should_continue():
+            self.start_turn()
+            return True
+        return False
+
     # when self.completion is set, update the messages
     def __setattr__(self, name, value):
         super().__setattr__(name, value)
@@ -58,5 +157,48 @@ class Agent:
             self.update_messages()
 
     def update_messages(self):
-        self.messages = run(self.messages, self.completion, self.tools)
-        self.completion = None
\ No newline at end of file
+        self.trace_completion(self.completion)
+        self.messages = run(self.messages, self.completion, self.tools,
+                            parallel_tool_calls=self.parallel_tool_calls,
+                            max_workers=self.max_workers,
+                            timeout=self.tool_timeout,
+                            shaper=self.result_shaper,
+                            hooks=self.turn)
+        if self.journal:
+            # the turn is on disk before the next completion is requested
+            self.journal.commit()
+        self.completion = None
+
+
+class AsyncAgent(Agent):
+    """An Agent for use with AsyncOpenAI. Iterate with `async for` and pass each completion to `await agent.step(completion)`"""
+
+    # completions are passed to step instead of being set on the agent
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.prepare()
+        if self.resumed:
+            await asyncio.to_thread(self.resume)
+        if isinstance(self.messages, Messages) and self.messages.listeners:
+            # waiting for new messages blocks, so wait outside the event loop
+            self.messages = await asyncio.to_thread(running, self.messages, verbose=self.verbose)
+        else:
+            self.messages = running(self.messages, verbose=self.verbose)
+
+        if not self.should_continue():
+            raise StopAsyncIteration
+        self.start_turn()
+        return self.messages
+
+    async def step(self, completion):
+        self.trace_completion(completion)
+        self.messages = await arun(self.messages, completion, self.tools, timeout=self.tool_timeout,
+                                   shaper=self.result_shaper, hooks=self.turn)
+        if self.journal:
+            await asyncio.to_thread(self.journal.commit)
+        return self.messages
@@ -1,8 +1,22 @@
 from threading import Event, Thread
+import asyncio
 import threading
-from queue import Queue
+import copy
+from queue import Queue, Empty, Full
+from collections import OrderedDict
 import json
 import os
+import time
+from .tracing import null_tracer
+
+
+# guards the creation of FunctionSet clients, which only happens once per tool
+client_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    """Roughly count the tokens in text, about 4 characters each for English"""
+    return (len(text) + 3) // 4
 
 
 class JSONSerializableFunction(dict):
@@ -17,8 +31,9 @@ class FunctionSet():
     tools = None
     system = None
     token_env_name = None
+    pool_size = 10
 
-    def __init__(self, token=None, functions=None):
+    def __init__(self, token=None, functions=None, pool_size=None):
         self.token = token
         # try and load the token from the environment
         if token is None and self.token_env_name:
@@ -26,6 +41,8 @@ class FunctionSet():
                 self.token = os.environ[self.token_env_name]
             except KeyError:
                 pass
+        if pool_size is not None:
+            self.pool_size = pool_size
 
         self.functions_map = self.create_functions_map()
         self.functions = self.instantiate_functions(functions)
@@ -42,6 +59,33 @@ class FunctionSet():
             functions = self.functions_map.keys()
         return [self.functions_map[function](self) for function in functions]
 
+    @property
+    def client(self):
+        """A long-lived API client shared by all functions of this tool, created on first use"""
+        client = self.__dict__.get('_client')
+        if client is None:
+            with client_lock:
+                client = self.__dict__.get('_client')
+                if client is None:
+                    client = self._client = self.create_client()
+        return client
+
+    def create_client(self):
+        """Tools that call an API should override this to create a client with up to pool_size connections"""
+        return None
+
+    def close(self):
+        """Close the client and its connections. A new client is created if the tool is used again"""
+        client = self.__dict__.pop('_client', None)
+        if client is not None and hasattr(client, 'close'):
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def __iter__(self):
         return iter(self.functions)
 
@@ -53,10 +97,103 @@ class FunctionSet():
         return cls
 
 
+class ToolCache:
+    """A least recently used cache of the results of one tool function, which expire after ttl seconds.
+    Entries are tagged, so that functions that change data can invalidate the results that read it.
+    Every cache is kept in ToolCache.caches, so all of them can be invalidated together and their stats read.
+    Results are copied when they are stored and returned, so a caller that changes a result doesn't change
+    what later callers get"""
+
+    caches = []
+    caches_lock = threading.Lock()
+
+    def __init__(self, name, ttl=300, max_entries=256):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        with self.caches_lock:
+            self.caches.append(self)
+
+    def get(self, key):
+        """Return (True, result) if there is a result for key that hasn't expired, otherwise (False, None)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, copy.deepcopy(entry[1])
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, result, tags=()):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(result), frozenset(tags))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        tags = set(tags)
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[2] & tags]:
+                del self.entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+        }
+
+    @classmethod
+    def invalidate_all(cls, tags):
+        for cache in list(cls.caches):
+            cache.invalidate(tags)
+
+    @classmethod
+    def clear_all(cls):
+        for cache in list(cls.caches):
+            cache.clear()
+
+    @classmethod
+    def stats(cls):
+        """The hits, misses, evictions, invalidations and size of each cache, by function name"""
+        return {cache.name: cache.info() for cache in list(cls.caches)}
+
+
 class Messages(list):
+    """A list of messages that can be filled by listeners.
+    Set max_tokens to keep the messages within a context window: when there are more tokens than that,
+    compact() first replaces the output of old tool calls, with summarize(message) if given, and then
+    removes the oldest turns. The system message, the latest user message with the turn after it, and the
+    last keep_last turns are always kept.
+    With a journal, see journal.py, every change made by append, compact and clear is also written to it"""
+
+    # per message overhead of the chat format
+    message_overhead = 4
 
     # accept verbose as a parameter in addition to the messages
-    def __init__(self, *args, verbose=False, print_fn=None, listeners=[]):
+    def __init__(self, *args, verbose=False, print_fn=None, listeners=[],
+                 max_tokens=None, keep_last=4, count_tokens=None, summarize=None, journal=None):
         super().__init__(*args)
         self.verbose = verbose
         self.print_fn = print_fn
@@ -65,78 +202,392 @@ class Messages(list):
         self.listeners = listeners
         self.system = None
 
+        self.max_tokens = max_tokens
+        self.keep_last = keep_last
+        self.count_tokens = count_tokens or estimate_tokens
+        self.summarize = summarize
+        self.tokens = sum(self.message_tokens(message) for message in self)
+        self.compacted = set()
+
         # if verbose and self:
         #     for message in self:
         #         self.print_fn(message)
 
+        # the listener and session of the conversation's first message, which its replies are sent to
+        self.source = None
+        self.session = None
+
+        # set by Agent and Runtime when they have tracing hooks
+        self.tracer = null_tracer
+        self.journal = journal
         if listeners:
-            self.condition = threading.Condition()
-            self.threads = []
-            for listener in listeners:
-                thread = threading.Thread(target=listener.listen, args=(
-                    self,), daemon=True)
-                thread.start()
-                self.threads.append(thread)
+            self.multiplexer = Multiplexer(listeners)
 
     # override append to check if verbose is set
     def append(self, message):
         if self.system and not self:
             super().append(self.system)
+            self.tokens += self.message_tokens(self.system)
+            if self.journal:
+                self.journal.append(self.system)
             if self.verbose:
                 self.print_fn(self.system)
 
         if self.verbose:
-            self.print_fn(message)
+            with self.tracer.span("render", message["role"]):
+                self.print_fn(message)
 
         super().append(message)
+        self.tokens += self.message_tokens(message)
+        if self.journal:
+            self.journal.append(message)
 
-        for listener in self.listeners:
-            listener.receive_message(message)
+        for listener in ([self.source] if self.source else self.listeners):
+            listener.receive_message(message, session=self.session)
 
-        if hasattr(self, 'condition'):
-            with self.condition:
-                self.condition.notify()
+    def stream_token(self, token):
+        """Pass a token of an assistant message that is still being streamed to the listeners"""
+        for listener in ([self.source] if self.source else self.listeners):
+            listener.receive_token(token, session=self.session)
 
     def block_if_empty(self):
-        with self.condition:
-            while not self:
-                self.condition.wait()
+        """Start a new conversation with the next message from the listeners, waiting for one if needed"""
+        if not self:
+            source, message, session = self.multiplexer.next_message()
+            if message is not None:
+                self.source = source
+                self.session = session
+                self.append(message)
+
+    def exit(self):
+        for listener in self.listeners:
+            listener.exit_event.set()
+        self.multiplexer.notify()
 
     def clear_if_finished(self):
         if self and (self[-1]['role'] == 'assistant' and 'tool_calls' not in self[-1]):
             self.clear()
 
+    def clear(self):
+        super().clear()
+        self.tokens = 0
+        self.source = None
+        self.session = None
+        self.compacted.clear()
+        if self.journal:
+            self.journal.clear()
+
+    def restore(self, messages):
+        """Replace the messages with messages restored from a journal, without writing them to it again"""
+        super().clear()
+        super().extend(messages)
+        self.tokens = sum(self.message_tokens(message) for message in self)
+        self.compacted.clear()
+
+    def message_tokens(self, message):
+        content = message.get('content') or ''
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False, default=str)
+        tokens = self.count_tokens(content) + self.message_overhead
+
+        for tool_call in message.get('tool_calls') or []:
+            tokens += self.count_tokens(tool_call['function']['name'] + tool_call['function']['arguments'])
+        return tokens
+
+    def turns(self):
+        """Group the messages so an assistant message with tool_calls is followed by its tool replies"""
+        turns = []
+        for index, message in enumerate(self):
+            if message['role'] == 'tool' and turns and self[turns[-1][0]].get('tool_calls'):
+                turns[-1].append(index)
+            else:
+                turns.append([index])
+        return turns
+
+    def compact(self):
+        """Bring the messages within max_tokens, see Messages"""
+        if self.max_tokens is None or self.tokens <= self.max_tokens:
+            return
+
+        turns = self.turns()
+        pinned = set(index for turn in turns[-self.keep_last:] for index in turn) if self.keep_last else set()
+        if self and self[0]['role'] == 'system':
+            pinned.add(0)
+
+        # the latest user message is the task being worked on, so keep it and the turn that answers it
+        for position in range(len(turns) - 1, -1, -1):
+            if self[turns[position][0]]['role'] == 'user':
+                pinned.update(index for turn in turns[position:position + 2] for index in turn)
+                break
+
+        # first replace old tool output, oldest first
+        for turn in turns:
+            for index in turn:
+                if self.tokens <= self.max_tokens:
+                    return
+                message = self[index]
+                if index in pinned or message['role'] != 'tool' or id(message) in self.compacted:
+                    continue
+
+                before = self.message_tokens(message)
+                if self.summarize:
+                    content = self.summarize(message)
+                else:
+                    content = f"[{before} tokens of tool output removed to save space]"
+                # replace rather than change the message, which listeners may still hold
+                self[index] = {**message, 'content': content}
+                self.compacted.add(id(self[index]))
+                if self.journal:
+                    self.journal.replace(index, self[index])
+                self.tokens += self.message_tokens(self[index]) - before
+
+        # then remove the oldest turns, whole
+        removed = set()
+        for turn in turns:
+            if self.tokens <= self.max_tokens:
+                break
+            if any(index in pinned for index in turn):
+                continue
+            for index in turn:
+                self.tokens -= self.message_tokens(self[index])
+                removed.add(index)
+
+        if removed:
+            self[:] = [message for index, message in enumerate(self) if index not in removed]
+            if self.journal:
+                self.journal.remove(removed)
+
     def __repr__(self):
         return json.dumps(self, indent=2, ensure_ascii=False)
 
 
+class ToolRegistry(list):
+    """An immutable list of tools, indexed by function name. It is built once by import_tools and
+    Agent.add_tools, can be passed directly as tools= to the OpenAI SDK, and lets run() find tools in O(1)"""
+
+    # sentinel so the first system message is always bound, even if it is None
+    UNBOUND = object()
+
+    def __init__(self, tools=()):
+        super().__init__(tools)
+        self.tool_map = {}
+        self.functions = {}
+        self.system = self.UNBOUND
+
+        for tool in self:
+            name = tool['function']['name']
+            self.tool_map[name] = tool
+            self.functions[name] = getattr(tool, name)
+            tool.tools = self
+
+    def copy(self):
+        """A registry of new function objects for the same tools, so state kept on the functions, such as
+        the system message of the System tool, isn't shared. Clients and caches of the tools are shared"""
+        return ToolRegistry([type(tool)(tool.tool) for tool in self])
+
+    # copy.copy and copy.deepcopy make a registry of new function objects, sharing the clients of the tools
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def __reduce__(self):
+        return ToolRegistry, (list(self),)
+
+    def __add__(self, other):
+        # tools + other_tools and tools += other_tools make a new registry
+        return ToolRegistry([*self, *other])
+
+    __iadd__ = __add__
+
+    def bind_system(self, system):
+        # only update the tools when the system message has changed
+        if system is not self.system:
+            for tool in self:
+                tool.system = system
+            self.system = system
+
+    def close(self):
+        """Close the clients of all tools in the registry"""
+        function_sets = {id(tool.tool): tool.tool for tool in self if isinstance(tool.tool, FunctionSet)}
+        for function_set in function_sets.values():
+            function_set.close()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("ToolRegistry is immutable, create a new one with ToolRegistry([*tools, *other_tools])")
+
+    append = extend = insert = remove = pop = clear = sort = reverse = _immutable
+    __setitem__ = __delitem__ = __imul__ = _immutable
+
+
+class Multiplexer:
+    """Merges the messages of several listeners into one conversation. Whenever the conversation is idle,
+    the next message is taken from the listeners in weighted round-robin order, so a busy listener can't
+    starve the others. A listener with weight 2 gets two turns for every turn of a listener with weight 1.
+    Listeners notify the multiplexer when they receive a message, so it never polls"""
+
+    def __init__(self, listeners):
+        self.listeners = listeners
+        self.condition = threading.Condition()
+        self.schedule = [listener for listener in listeners for _ in range(max(1, listener.weight))]
+        self.position = 0
+        self.tracer = null_tracer
+
+        for listener in listeners:
+            listener.multiplexer = self
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def next_message(self):
+        """Wait for a message and return (listener, message, session), or (None, None, None) once every
+        listener has exited"""
+        with self.condition:
+            taken = self.take_message()
+            while taken is None:
+                if all(listener.exit_event.is_set() for listener in self.listeners):
+                    return None, None, None
+                self.condition.wait()
+                taken = self.take_message()
+
+        # the wait is traced outside the lock, so slow hooks don't hold up the listeners
+        listener, message, session, wait = taken
+        self.tracer.record("queue_wait", type(listener).__name__, wait, session=session)
+        return listener, message, session
+
+    def take_message(self):
+        # the next message in schedule order, with how long it waited, or None if every queue is empty
+        for offset in range(len(self.schedule)):
+            listener = self.schedule[(self.position + offset) % len(self.schedule)]
+            try:
+                message, session, queued_at = listener.message_queue.get_nowait()
+            except Empty:
+                continue
+            self.position = (self.position + offset + 1) % len(self.schedule)
+            return listener, message, session, listener.record_wait(queued_at)
+        return None
+
+
+class MessageQueueFull(Exception):
+    """Raised by MessageQueue.put_message when the queue is full, and its overflow policy is reject or
+    it has blocked for longer than block_timeout. status is the HTTP status servers answer with"""
+
+    def __init__(self, message, status=429):
+        super().__init__(message)
+        # a rejected message can be retried soon, while a queue that stayed full is unavailable
+        self.status = status
+
+
 class MessageQueue:
-    def __init__(self):
-        self.message_queue = Queue()
-        self.new_message_event = Event()
+    # the share of turns this listener gets when there are several, see Multiplexer
+    weight = 1
+    multiplexer = None
+
+    # what to do with a new message when maxsize messages are waiting:
+    # "block" until there is room, "drop_oldest" to make room, or "reject" with MessageQueueFull
+    maxsize = 1000
+    overflow = "block"
+    block_timeout = None
+
+    def __init__(self, maxsize=None, overflow=None):
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if overflow is not None:
+            self.overflow = overflow
+        if self.overflow not in ("block", "drop_oldest", "reject"):
+            raise ValueError(f"Unknown overflow policy {self.overflow}")
+
+        self.message_queue = Queue(maxsize=self.maxsize)
         self.ready_for_input = Event()
         self.exit_event = Event() 
         self.ready_for_input.set()
-        self.thread = self.start_client()
         self.messages = []
 
-    def receive_message(self, message):
+        self.metrics_lock = threading.Lock()
+        self.received = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        self.thread = self.start_client()
+
+    def receive_message(self, message, session=None):
         self.messages.append(message)
 
-    def put_message(self, message):
-        self.message_queue.put(message)
-        self.new_message_event.set()
-
-    def listen(self, messages):
-        while not self.exit_event.is_set():
-            
-            self.new_message_event.wait()
-            while not self.message_queue.empty():
-                incoming_message = self.message_queue.get()
-                messages.append(incoming_message)
-            self.new_message_event.clear()
-            if not messages:
-                self.ready_for_input.set()
+    def receive_token(self, token, session=None):
+        """Called with each token of a streamed assistant message, before the whole message is received"""
+        pass
+
+    def put_message(self, message, session=None):
+        """Queue a message from a conversation. session identifies the conversation, e.g. a Slack thread,
+        so that Runtime can keep a separate history for each"""
+        item = (message, session, time.monotonic())
+        if self.overflow == "block":
+            try:
+                self.message_queue.put(item, timeout=self.block_timeout)
+            except Full:
+                self.count("rejected")
+                raise MessageQueueFull(f"{type(self).__name__} queue is full", status=503)
+        elif self.overflow == "drop_oldest":
+            while True:
+                try:
+                    self.message_queue.put_nowait(item)
+                    break
+                except Full:
+                    try:
+                        self.message_queue.get_nowait()
+                        self.count("dropped")
+                    except Empty:
+                        pass
+        else:
+            try:
+                self.message_queue.put_nowait(item)
+            except Full:
+                self.count("rejected")
+                raise MessageQueueFull(f"{type(self).__name__} queue is full")
+
+        self.count("received")
+        if self.multiplexer is not None:
+            self.multiplexer.notify()
+
+    async def aput_message(self, message, session=None):
+        """Async version of put_message for servers. With overflow block the wait for room runs in a
+        thread, so it doesn't block the server's event loop"""
+        if self.overflow == "block":
+            await asyncio.to_thread(self.put_message, message, session)
+        else:
+            self.put_message(message, session)
+
+    def count(self, metric):
+        with self.metrics_lock:
+            setattr(self, metric, getattr(self, metric) + 1)
+
+    def record_wait(self, queued_at):
+        """Record how long a message waited in the queue before the agent took it"""
+        wait = time.monotonic() - queued_at
+        with self.metrics_lock:
+            self.waits += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    def stats(self):
+        """The queue's depth and capacity, counts of received, dropped and rejected messages, and how long
+        messages waited in seconds"""
+        with self.metrics_lock:
+            return {
+                "depth": self.message_queue.qsize(),
+                "maxsize": self.maxsize,
+                "received": self.received,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "average_wait": self.total_wait / self.waits if self.waits else 0.0,
+                "max_wait": self.max_wait,
+            }
 
     def client_thread(self):
         raise NotImplementedError("Subclasses should implement this method")
@@ -2,7 +2,7 @@ import argparse
 import os
 import json
 import sys
-from . import Agent
+from . import Agent, ResultShaper
 from openai import OpenAI, AzureOpenAI
 
 def main():
@@ -15,6 +15,11 @@ def main():
     parser.add_argument('--endpoint', help='Change the OpenAI endpoint, e.g., for use with Ollama')
     parser.add_argument('--all', action='store_true', help='Output all messages, default is to output only the last message')
     parser.add_argument('--system', default=None, help='Optional system message to initialize the agent')
+    parser.add_argument('--parallel', action='store_true', help='Run parallel tool calls concurrently')
+    parser.add_argument('--tool-timeout', type=float, default=None, help='Seconds to wait for each tool call when --parallel is set')
+    parser.add_argument('--max-context-tokens', type=int, default=None, help='Compact the messages once they are longer than this many tokens')
+    parser.add_argument('--journal', default=None, help='Write the conversation to this file, and resume it from there after a crash')
+    parser.add_argument('--tool-max-tokens', type=int, default=None, help='Truncate each tool result to about this many tokens')
 
     parser.add_argument('message', nargs='?', help='Optional message to be pushed via stdin when messages=CLI')
     args = parser.parse_args()
@@ -49,10 +54,13 @@ def main():
             sys.stdout = open(os.devnull, 'w')
             args.message = sys.stdin.read().strip()
 
-    if args.system:
-        agent = Agent(args.system, verbose=False if args.message else True).add_tools(tools_input)
-    else:
-        agent = Agent(verbose=False if args.message else True).add_tools(tools_input)
+    agent = Agent(args.system,
+                  verbose=False if args.message else True,
+                  parallel_tool_calls=args.parallel,
+                  tool_timeout=args.tool_timeout,
+                  result_shaper=ResultShaper(max_tokens=args.tool_max_tokens),
+                  max_context_tokens=args.max_context_tokens,
+                  journal=args.journal).add_tools(tools_input)
 
     if args.message:
         agent.add_messages(args.message)
@@ -0,0 +1,222 @@
+import atexit
+import base64
+import functools
+import json
+import os
+import threading
+import time
+import zlib
+
+
+@functools.lru_cache(maxsize=None)
+def zstd():
+    # zstandard is optional, zlib is used without it
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def compress(data):
+    if zstd() is not None:
+        return "zstd", zstd().ZstdCompressor().compress(data)
+    return "zlib", zlib.compress(data)
+
+
+def decompress(codec, data):
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if zstd() is None:
+        raise ImportError("This journal has zstd compressed messages, install zstandard to read it")
+    return zstd().ZstdDecompressor().decompress(data)
+
+
+class Journal:
+    """An append-only file of the changes to a conversation, one JSON record per line, so the conversation
+    can be restored after a crash with load(). Each turn only writes its new messages, and the result of
+    each tool call as soon as it returns, so tool calls that finished before a crash aren't run again.
+
+    Records are written to the file at once, unbuffered so they survive the process crashing, and a
+    background thread fsyncs them sync_interval seconds later, so the records written meanwhile share
+    one fsync. commit() waits until everything written so far is on disk. Message contents longer than compress_over characters are compressed with zstd if
+    zstandard is installed, or zlib otherwise"""
+
+    def __init__(self, path, sync_interval=0.05, compress_over=4096):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compress_over = compress_over
+
+        self.file = None
+        self.condition = threading.Condition()
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+        self.closed = False
+        self.thread = None
+
+        # the results of tool calls in the journal, by tool call ID
+        self.results = {}
+
+    def load(self):
+        """Replay the journal and return its messages. A record cut short by a crash is discarded"""
+        messages = []
+        records = 0
+        size = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line) if line.endswith(b"\n") else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        break
+                    size += len(line)
+                    records += 1
+                    messages = self.replay(messages, record)
+
+        self.file = open(self.path, "ab", buffering=0)
+        if self.file.tell() > size:
+            self.file.truncate(size)
+
+        # start again from the current messages when most records are of messages that are gone
+        if records > 2 * (len(messages) + len(self.results)) + 100:
+            self.rewrite(messages)
+        return messages
+
+    def replay(self, messages, record):
+        op = record["op"]
+        if op == "append":
+            messages.append(self.decode(record))
+        elif op == "replace":
+            messages[record["index"]] = self.decode(record)
+        elif op == "remove":
+            removed = set(record["indices"])
+            messages = [message for index, message in enumerate(messages) if index not in removed]
+        elif op == "result":
+            self.results[record["message"]["tool_call_id"]] = self.decode(record)["content"]
+        elif op == "clear":
+            messages = []
+            self.results = {}
+        return messages
+
+    def encode(self, record, message):
+        content = message.get("content")
+        if isinstance(content, str) and len(content) > self.compress_over:
+            record["codec"], data = compress(content.encode("utf-8"))
+            record["content"] = base64.b64encode(data).decode("ascii")
+            message = {key: value for key, value in message.items() if key != "content"}
+        record["message"] = message
+        return json.dumps(record, ensure_ascii=False, default=str, separators=(",", ":")) + "\n"
+
+    def decode(self, record):
+        message = record["message"]
+        if "codec" in record:
+            message["content"] = decompress(record["codec"], base64.b64decode(record["content"])).decode("utf-8")
+        return message
+
+    def write(self, line):
+        with self.condition:
+            if self.file is None:
+                self.file = open(self.path, "ab", buffering=0)
+            self.file.write(line.encode("utf-8"))
+            self.written += 1
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.sync_forever, daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+            self.condition.notify_all()
+
+    def append(self, message):
+        self.write(self.encode({"op": "append"}, message))
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def replace(self, index, message):
+        self.write(self.encode({"op": "replace", "index": index}, message))
+
+    def result(self, tool_call_id, result):
+        """Write the result of a tool call, before its tool message is appended"""
+        self.write(self.encode({"op": "result"}, {"tool_call_id": tool_call_id, "content": result}))
+
+    def remove(self, indices):
+        self.write(json.dumps({"op": "remove", "indices": sorted(indices)}) + "\n")
+
+    def clear(self):
+        """Start again with an empty journal, once a conversation has finished"""
+        with self.condition:
+            if self.file is None:
+                return
+            self.file.flush()
+            self.file.truncate(0)
+            self.results = {}
+            # the truncation is synced like a record
+            self.written += 1
+            self.condition.notify_all()
+
+    def rewrite(self, messages):
+        # write the messages, and results without a tool message, to a new file and replace the journal with it
+        answered = set(message.get("tool_call_id") for message in messages)
+        with open(self.path + ".tmp", "wb") as f:
+            for message in messages:
+                f.write(self.encode({"op": "append"}, message).encode("utf-8"))
+            for tool_call_id, result in self.results.items():
+                if tool_call_id not in answered:
+                    f.write(self.encode({"op": "result"}, {"tool_call_id": tool_call_id, "content": result}).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        with self.condition:
+            self.file.close()
+            os.replace(self.path + ".tmp", self.path)
+            self.file = open(self.path, "ab", buffering=0)
+
+    def commit(self):
+        """Wait until every record written so far is on disk. Callers that commit at the same time
+        share one fsync"""
+        with self.condition:
+            target = self.written
+            while self.synced < target:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+
+                self.syncing = True
+                written = self.written
+                self.file.flush()
+                synced = False
+                # writers can go on writing during the fsync
+                self.condition.release()
+                try:
+                    os.fsync(self.file.fileno())
+                    synced = True
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    if synced:
+                        self.synced = max(self.synced, written)
+                    self.condition.notify_all()
+
+    def sync_forever(self):
+        while True:
+            with self.condition:
+                while self.synced >= self.written and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+            # wait a little, so one fsync covers the records written meanwhile
+            time.sleep(self.sync_interval)
+            self.commit()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.commit()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            self.file.close()
+            self.file = None
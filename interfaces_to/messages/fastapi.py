@@ -1,29 +1,168 @@
+import asyncio
+import json
 import logging
+from collections import deque
 from fastapi import FastAPI as FastAPIBase, Request, HTTPException
-from ..bases import MessageQueue
+from fastapi.responses import StreamingResponse
+from ..bases import MessageQueue, MessageQueueFull
 #from ..utils import message_auth
+import threading
 import uvicorn
+import uuid
+
+
+class Reply:
+    """A request waiting for the end of its conversation turn. It can wait for the final assistant
+    message, stream events as they happen, or neither when the request was only acknowledged"""
+
+    def __init__(self, loop=None, wait=False, stream=False):
+        self.loop = loop
+        self.future = loop.create_future() if wait else None
+        self.events = asyncio.Queue() if stream else None
+
+    def send(self, event, data):
+        if self.events is not None:
+            self.loop.call_soon_threadsafe(self.events.put_nowait, (event, data))
+
+    def finish(self, message):
+        self.send("done", message)
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(self.resolve, message)
+
+    def resolve(self, message):
+        # the request may have timed out already
+        if not self.future.done():
+            self.future.set_result(message)
+
 
 #@message_auth(['FASTAPI_AUTHTOKEN'])
 class FastAPI(MessageQueue):
-    def __init__(self):
-        super().__init__()
+    """Receives messages on POST /message. By default the request returns as soon as the message is queued.
+    With ?wait=true it returns the assistant's reply, and POST /message/stream streams the reply as
+    server-sent events: token, tool_call, tool_result and done. Requests are refused with 429 when
+    max_pending messages are already waiting for a reply"""
+
+    overflow = "reject"
+
+    def __init__(self, max_pending=100, timeout=120, host="0.0.0.0", port=8080, maxsize=None, overflow=None):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.host = host
+        self.port = port
+
+        # the requests of each conversation, in the order their messages were received
+        self.replies = {}
+        self.replies_lock = threading.Lock()
+        self.pending = 0
+
         self.app = FastAPIBase()
 
         @self.app.post("/message")
-        async def message(request: Request):
+        async def message(request: Request, wait: bool = False):
+            session, reply = await self.receive(request, wait=wait)
+            if not wait:
+                return {"message": "Message received and processed", "conversation_id": session}
+
             try:
-                data = await request.body()
-                formatted_message = {
-                    "role": "user",
-                    "content": f"Respond to the message you received. The message says: {data.decode('utf-8')}"
-                }
-                self.put_message(formatted_message)
-                return {"message": "Message received and processed"}
-            except Exception as e:
-                logging.error(f"Error processing message: {e}")
-                raise HTTPException(status_code=500, detail="Failed to process message")
+                reply_message = await asyncio.wait_for(reply.future, self.timeout)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail="Timed out waiting for a reply")
+            return {"conversation_id": session, "message": reply_message.get("content")}
+
+        @self.app.post("/message/stream")
+        async def message_stream(request: Request):
+            session, reply = await self.receive(request, stream=True)
+
+            async def events():
+                yield f"event: conversation\ndata: {json.dumps({'conversation_id': session})}\n\n"
+                while True:
+                    try:
+                        event, data = await asyncio.wait_for(reply.events.get(), self.timeout)
+                    except asyncio.TimeoutError:
+                        yield "event: error\ndata: {\"detail\": \"Timed out waiting for a reply\"}\n\n"
+                        return
+                    yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+                    if event == "done":
+                        return
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        # the server is started by MessageQueue, once the app is ready
+        super().__init__(maxsize, overflow)
+
+    async def receive(self, request, wait=False, stream=False):
+        try:
+            data = await request.body()
+            # callers can continue a conversation by sending the same conversation ID
+            session = request.headers.get("X-Conversation-Id") or str(uuid.uuid4())
+            formatted_message = {
+                "role": "user",
+                "content": f"Respond to the message you received. The message says: {data.decode('utf-8')}"
+            }
+        except Exception as e:
+            logging.error(f"Error processing message: {e}")
+            raise HTTPException(status_code=500, detail="Failed to process message")
+
+        # every request is queued, so each turn's reply goes to the request that started it
+        reply = Reply(asyncio.get_running_loop(), wait=wait, stream=stream)
+        with self.replies_lock:
+            # refuse messages while too many are waiting for a reply, rather than queueing without limit
+            if self.pending >= self.max_pending:
+                raise HTTPException(status_code=429, detail="Too many messages waiting", headers={"Retry-After": "1"})
+            self.replies.setdefault(session, deque()).append(reply)
+            self.pending += 1
+
+        try:
+            await self.aput_message(formatted_message, session)
+        except MessageQueueFull as e:
+            self.cancel_reply(session, reply)
+            raise HTTPException(status_code=e.status, detail="Too many messages waiting", headers={"Retry-After": "1"})
+        return session, reply
+
+    def cancel_reply(self, session, reply):
+        with self.replies_lock:
+            replies = self.replies.get(session)
+            if replies and reply in replies:
+                replies.remove(reply)
+                self.pending -= 1
+                if not replies:
+                    del self.replies[session]
+
+    def current_reply(self, session, finished=False):
+        with self.replies_lock:
+            replies = self.replies.get(session)
+            if not replies:
+                return None
+            if not finished:
+                return replies[0]
+            reply = replies.popleft()
+            self.pending -= 1
+            if not replies:
+                del self.replies[session]
+            return reply
+
+    def receive_message(self, message, session=None):
+        super().receive_message(message, session)
+
+        if message["role"] == "assistant" and message.get("tool_calls"):
+            reply = self.current_reply(session)
+            if reply:
+                for tool_call in message["tool_calls"]:
+                    reply.send("tool_call", {"id": tool_call["id"], **tool_call["function"]})
+        elif message["role"] == "tool":
+            reply = self.current_reply(session)
+            if reply:
+                reply.send("tool_result", {"tool_call_id": message["tool_call_id"], "content": message["content"]})
+        elif message["role"] == "assistant":
+            reply = self.current_reply(session, finished=True)
+            if reply:
+                reply.finish(message)
+
+    def receive_token(self, token, session=None):
+        reply = self.current_reply(session)
+        if reply:
+            reply.send("token", token)
 
     def client_thread(self):
-        print("Listening on http://0.0.0.0:8080")
-        uvicorn.run(self.app, host="0.0.0.0", port=8080)
+        print(f"Listening on http://{self.host}:{self.port}")
+        uvicorn.run(self.app, host=self.host, port=self.port)
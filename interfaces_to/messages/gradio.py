@@ -3,9 +3,9 @@ from ..bases import MessageQueue
 
 class Gradio(MessageQueue):
 
-    def receive_message(self, message):
+    def receive_message(self, message, session=None):
         self.history.append({"role": message['role'], "content": message['content']})
-        return super().receive_message(message)
+        return super().receive_message(message, session)
 
     def start_client(self):
 
@@ -2,20 +2,28 @@ import asyncio
 from aiohttp import web
 import logging
 import ngrok
-from ..bases import MessageQueue
+import uuid
+from ..bases import MessageQueue, MessageQueueFull
 from ..utils import message_auth
 
 @message_auth(['NGROK_AUTHTOKEN'])
 class Ngrok(MessageQueue):
+
+    overflow = "reject"
+
     async def message(self, request):
         try:
             data = await request.text()
+            # callers can continue a conversation by sending the same conversation ID
+            session = request.headers.get("X-Conversation-Id") or str(uuid.uuid4())
             formatted_message = {
                 "role": "user",
                 "content": f"Respond to the message you received. The message says: {data}"
             }
-            self.put_message(formatted_message)
-            return web.Response(text="Message received and processed")
+            await self.aput_message(formatted_message, session)
+            return web.Response(text="Message received and processed", headers={"X-Conversation-Id": session})
+        except MessageQueueFull as e:
+            return web.Response(text="Too many messages waiting", status=e.status, headers={"Retry-After": "1"})
         except Exception as e:
             logging.error(f"Error processing message: {e}")
             return web.Response(text="Failed to process message", status=500)
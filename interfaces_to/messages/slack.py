@@ -2,25 +2,83 @@ from slack_sdk.web import WebClient
 from slack_sdk.socket_mode import SocketModeClient
 from slack_sdk.socket_mode.response import SocketModeResponse
 from slack_sdk.socket_mode.request import SocketModeRequest
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
 from ..bases import MessageQueue
 from ..utils import message_auth
+from ..tools.slack import ChannelDirectory
 
 @message_auth(['SLACK_APP_TOKEN', 'SLACK_BOT_TOKEN'])
 class Slack(MessageQueue):
+
+    # remember this many recent event IDs, to ignore events that Slack delivers again
+    dedupe_size = 1000
+
+    # events have already been acknowledged, so under a burst the oldest waiting messages are dropped
+    overflow = "drop_oldest"
+
+    def __init__(self, maxsize=None, overflow=None):
+        self.bot_user_id = None
+        self.recent_events = OrderedDict()
+        self.recent_events_lock = threading.Lock()
+
+        # events are handled in order on one worker, so the socket thread only has to acknowledge them
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        super().__init__(maxsize, overflow)
+
+    def is_duplicate(self, *keys):
+        """Return True if any of keys was seen recently, and remember them"""
+        keys = [key for key in keys if key]
+        with self.recent_events_lock:
+            duplicate = any(key in self.recent_events for key in keys)
+            for key in keys:
+                self.recent_events[key] = True
+                self.recent_events.move_to_end(key)
+            while len(self.recent_events) > self.dedupe_size:
+                self.recent_events.popitem(last=False)
+        return duplicate
+
     def _process_slack_event(self, client: SocketModeClient, req: SocketModeRequest):
         if req.type == "events_api":
             response = SocketModeResponse(envelope_id=req.envelope_id)
             client.send_socket_mode_response(response)
             event = req.payload["event"]
-            bot_user_id = client.web_client.auth_test()['user_id']
-            if not event.get("user") == bot_user_id:
+
+            # retried events have the same event_id, and a message that mentions the bot arrives both as
+            # a message and an app_mention event with the same client_msg_id
+            if self.is_duplicate(req.payload.get("event_id"), event.get("client_msg_id")):
+                return
+
+            self.executor.submit(self._handle_event, event)
+
+    def _handle_event(self, event):
+        try:
+            # keep the channels used by the Slack tool up to date
+            if event["type"] in ChannelDirectory.events:
+                ChannelDirectory.for_token(self.token['SLACK_BOT_TOKEN']).apply_event(event)
+                return
+
+            if not event.get("user") == self.bot_user_id:
                 formatted_message = {
                     "role": "user",
                     "content": f"Respond to the message you received from {event['user']} in channel ID {event['channel']}. The message says: {event['text']} "
                 }
-                self.put_message(formatted_message)
+                # each thread, or channel outside threads, is a separate conversation
+                dropped = self.dropped
+                self.put_message(formatted_message, session=f"{event['channel']}:{event.get('thread_ts', '')}")
+                if self.dropped > dropped:
+                    logging.warning(f"Slack queue is full, dropped {self.dropped - dropped} older message(s)")
+        except Exception as e:
+            logging.error(f"Error processing Slack event: {e}")
 
     def client_thread(self):
-        client = SocketModeClient(app_token=self.token['SLACK_APP_TOKEN'], web_client=WebClient(token=self.token['SLACK_BOT_TOKEN']))
+        web_client = WebClient(token=self.token['SLACK_BOT_TOKEN'])
+
+        # the bot's own messages are ignored, so look up its user ID once
+        self.bot_user_id = web_client.auth_test()['user_id']
+
+        client = SocketModeClient(app_token=self.token['SLACK_APP_TOKEN'], web_client=web_client)
         client.socket_mode_request_listeners.append(self._process_slack_event)
-        client.connect()
\ No newline at end of file
+        client.connect()
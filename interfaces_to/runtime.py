@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import read_messages, import_tools, running, run
+from .utils import unanswered_tool_calls
+from .bases import Messages, ToolRegistry
+from .tracing import as_tracer, completion_attributes
+
+
+class Session:
+    """The history and waiting messages of one conversation"""
+
+    def __init__(self, key, messages, tools):
+        self.key = key
+        self.messages = messages
+        # each session has its own copy of the tools, since the System tool keeps the system message on them
+        self.tools = tools
+        self.inbox = deque()
+        self.scheduled = False
+        self.last_active = time.monotonic()
+
+
+class Runtime:
+    """Runs an agent for each conversation of several listeners at once.
+    Messages are grouped into sessions by their listener and session, e.g. a Slack thread or the
+    X-Conversation-Id of an HTTP request, and each session keeps its own history. Sessions run
+    concurrently on a pool of workers, while the messages of each session are handled in order.
+
+    complete(messages, tools) should return a completion, e.g. from client.chat.completions.create.
+    hooks are called with a Span for each llm call, tool call and queue wait, see tracing.py"""
+
+    def __init__(self, listeners, tools=None, complete=None, workers=8, system_message=None,
+                 parallel_tool_calls=False, tool_timeout=None, result_shaper=None,
+                 max_context_tokens=None, keep_last_turns=4, session_ttl=3600, max_backlog=None, hooks=None):
+        self.messages = listeners if isinstance(listeners, Messages) else read_messages(listeners)
+        tools = import_tools(tools) if tools and isinstance(next(iter(tools)), str) else tools
+        self.tools = tools if isinstance(tools, ToolRegistry) else ToolRegistry(tools or [])
+        self.complete = complete
+        self.workers = workers
+        self.system = {"role": "system", "content": system_message} if system_message else None
+        self.parallel_tool_calls = parallel_tool_calls
+        self.tool_timeout = tool_timeout
+        self.result_shaper = result_shaper
+        self.max_context_tokens = max_context_tokens
+        self.keep_last_turns = keep_last_turns
+        self.session_ttl = session_ttl
+        self.tracer = as_tracer(hooks)
+        self.messages.multiplexer.tracer = self.tracer
+
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        # messages are only taken from the listeners while fewer than max_backlog are waiting in sessions,
+        # so a burst fills the listeners' queues, where their overflow policies apply
+        self.backlog = threading.Semaphore(max_backlog or workers * 4)
+        self.last_sweep = time.monotonic()
+
+    def session(self, listener, session):
+        key = (id(listener), session)
+        if key not in self.sessions:
+            messages = Messages(max_tokens=self.max_context_tokens, keep_last=self.keep_last_turns)
+            messages.system = self.system
+            messages.source = listener
+            messages.session = session
+            self.sessions[key] = Session(key, messages, self.tools.copy())
+        return self.sessions[key]
+
+    def dispatch(self, listener, message, session):
+        """Add a message to its session, and schedule the session if it isn't already"""
+        with self.lock:
+            session = self.session(listener, session)
+            session.inbox.append(message)
+            session.last_active = time.monotonic()
+            if not session.scheduled:
+                session.scheduled = True
+                self.executor.submit(self.drain, session)
+
+    def drain(self, session):
+        # only one worker drains a session at a time, which keeps its messages in order
+        while True:
+            with self.lock:
+                if not session.inbox:
+                    session.scheduled = False
+                    session.last_active = time.monotonic()
+                    return
+                message = session.inbox.popleft()
+            self.backlog.release()
+
+            try:
+                self.respond(session, message)
+            except Exception as e:
+                logging.error(f"Error in session {session.key[1]}: {e}")
+                # every tool call needs a reply, or the next completion of the session is refused
+                for tool_call in unanswered_tool_calls(session.messages):
+                    session.messages.append({"role": "tool", "tool_call_id": tool_call['id'], "content": f"Error: {e}"})
+                # end the turn, so the listener isn't left waiting for a reply
+                session.messages.append({"role": "assistant", "content": f"Error: {e}"})
+
+    def respond(self, session, message):
+        """Run the agent loop for a message until the assistant has replied"""
+        messages = session.messages
+        messages.append(message)
+        while running(messages, verbose=False):
+            turn = self.tracer.turn()
+            messages.tracer = turn
+            with turn.span("llm", messages=len(messages), session=messages.session) as span:
+                completion = self.complete(messages, session.tools)
+                if span.enabled:
+                    span.name = getattr(completion, "model", None)
+                    span.set(**completion_attributes(completion))
+            run(messages, completion, session.tools,
+                parallel_tool_calls=self.parallel_tool_calls,
+                timeout=self.tool_timeout,
+                shaper=self.result_shaper,
+                hooks=turn)
+
+    def sweep(self):
+        # forget sessions that have been idle for longer than session_ttl
+        now = time.monotonic()
+        if now - self.last_sweep < min(self.session_ttl, 60):
+            return
+        self.last_sweep = now
+        with self.lock:
+            for key, session in list(self.sessions.items()):
+                if not session.scheduled and now - session.last_active > self.session_ttl:
+                    del self.sessions[key]
+
+    def run_forever(self):
+        """Handle messages until every listener has exited"""
+        try:
+            while True:
+                self.backlog.acquire()
+                listener, message, session = self.messages.multiplexer.next_message()
+                if message is None:
+                    return
+                self.dispatch(listener, message, session)
+                self.sweep()
+        finally:
+            self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.tools.close()
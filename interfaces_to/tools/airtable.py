@@ -1,42 +1,148 @@
 from typing import List, Dict, Any
 from ..bases import FunctionSet
-from ..utils import callable_function, tool_auth
+from ..utils import callable_function, tool_auth, cacheable, invalidates
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+
+
+class RateLimiter:
+    """A token bucket that allows rate requests per second, with bursts of up to capacity requests"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop allowing requests for a number of seconds, e.g. after a 429 response"""
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
 
 @tool_auth(token_env_name='AIRTABLE_TOKEN')
 class Airtable(FunctionSet):
 
+    # Airtable allows 5 requests per second per base, and asks clients to wait 30 seconds after a 429
+    requests_per_second = 5
+    retry_after = 30
+    max_retries = 3
+
+    def __init__(self, token=None, functions=None, pool_size=None):
+        super().__init__(token, functions, pool_size)
+        self.limiters = {}
+        self.prefetcher = None
+        self.lock = threading.Lock()
+
+    def create_client(self):
+        # one keep-alive session is shared by all functions
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.headers['Authorization'] = f'Bearer {self.token}'
+        return session
+
+    def limiter(self, base_id):
+        """The rate limiter for a base, or for the meta API when base_id is None"""
+        with self.lock:
+            if base_id not in self.limiters:
+                self.limiters[base_id] = RateLimiter(self.requests_per_second)
+            return self.limiters[base_id]
+
+    def request(self, method, url, base_id=None, **kwargs):
+        """Send a request within the base's rate limit, backing off and retrying on 429 responses"""
+        limiter = self.limiter(base_id)
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            response = self.client.request(method, url, **kwargs)
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+            limiter.pause(float(response.headers.get('Retry-After', self.retry_after)))
+        return response
+
+    def get_page(self, url, params, base_id=None):
+        response = self.request('GET', url, base_id, params=params)
+        if response.status_code != 200:
+            raise Exception(f'Error: {response.status_code}, {response.text}')
+        return response.json()
+
+    def pages(self, url, params={}, base_id=None):
+        """Yield each page of a list, fetching the next page while the current one is being processed"""
+        with self.lock:
+            if self.prefetcher is None:
+                self.prefetcher = ThreadPoolExecutor(max_workers=self.pool_size)
+
+        data = self.get_page(url, params, base_id)
+        while True:
+            offset = data.get('offset')
+            next_page = self.prefetcher.submit(
+                self.get_page, url, {**params, 'offset': offset}, base_id) if offset else None
+            yield data
+            if next_page is None:
+                return
+            data = next_page.result()
+
+    def iter_base_records(self, base_id, table_id_or_name, fields=None, filter_by_formula=None,
+                          sort=None, view=None, max_records=None, page_size=100):
+        """Yield the records of a table one page at a time, without loading the whole table into memory.
+        fields, filter_by_formula, sort, view and max_records are applied by Airtable"""
+        url = f'https://api.airtable.com/v0/{base_id}/{table_id_or_name}'
+        params = {'pageSize': page_size}
+        if fields:
+            params['fields[]'] = list(fields)
+        if filter_by_formula:
+            params['filterByFormula'] = filter_by_formula
+        for i, sort_field in enumerate(sort or []):
+            params[f'sort[{i}][field]'] = sort_field['field']
+            params[f'sort[{i}][direction]'] = sort_field.get('direction', 'asc')
+        if view:
+            params['view'] = view
+        if max_records:
+            params['maxRecords'] = max_records
+
+        for data in self.pages(url, params, base_id):
+            yield from data.get('records', [])
+
+    def close(self):
+        with self.lock:
+            prefetcher, self.prefetcher = self.prefetcher, None
+        if prefetcher is not None:
+            prefetcher.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
     @callable_function
+    @cacheable(ttl=300, tags=['bases'])
     def list_all_bases(self):
         """
         List all bases in your Airtable account
         """
         url = 'https://api.airtable.com/v0/meta/bases'
-        headers = {
-            'Authorization': f'Bearer {self.token}'
-        }
         bases = []
-        offset = None
 
-        while True:
-            params = {}
-            if offset:
-                params['offset'] = offset
-
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code != 200:
-                raise Exception(f'Error: {response.status_code}, {response.text}')
-            
-            data = response.json()
+        for data in self.tool.pages(url):
             bases.extend(data.get('bases', []))
-            offset = data.get('offset')
 
-            if not offset:
-                break
-        
         return bases
     
     @callable_function
+    @cacheable(ttl=300, tags=['base:{base_id}'])
     def get_base(self, base_id: str):
         """
         Get schema of the specified base in your Airtable account, including tables and views, and their fields
@@ -44,51 +150,32 @@ class Airtable(FunctionSet):
         :param base_id: The ID of the base to retrieve the schema for.
         """
         url = f'https://api.airtable.com/v0/meta/bases/{base_id}/tables'
-        headers = {
-            'Authorization': f'Bearer {self.token}'
-        }
 
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            raise Exception(f'Error: {response.status_code}, {response.text}')
-        
-        return response.json()
+        return self.tool.get_page(url, {}, base_id)
 
     @callable_function
-    def list_base_records(self, base_id: str, table_id_or_name: str):
+    @cacheable(ttl=60, tags=['records:{base_id}:{table_id_or_name}'])
+    def list_base_records(self, base_id: str, table_id_or_name: str, fields: List[str] = None,
+                          filter_by_formula: str = None, sort: List[Dict[str, str]] = None,
+                          view: str = None, max_records: int = None):
         """
-        List records in a table in your Airtable account
+        List records in a table in your Airtable account. Use fields, filter_by_formula and max_records to only get the records and fields you need.
+        Records are cached for up to a minute, so changes made outside this tool can take that long to show
         
         :param base_id: The ID of the base.
         :param table_id_or_name: The ID or name of the table.
+        :param fields: Only return these fields, e.g. ["Name", "Email"]
+        :param filter_by_formula: Only return records for which this Airtable formula is true, e.g. {Status} = 'Done'
+        :param sort: Fields to sort by, e.g. [{"field": "Name", "direction": "asc"}]
+        :param view: The name or ID of a view. Only records in the view are returned, in the order of the view
+        :param max_records: The maximum number of records to return
         """
-        url = f'https://api.airtable.com/v0/{base_id}/{table_id_or_name}'
-        headers = {
-            'Authorization': f'Bearer {self.token}'
-        }
-
-        records = []
-        offset = None
-
-        while True:
-            params = {'pageSize': 100}
-            if offset:
-                params['offset'] = offset
-
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code != 200:
-                raise Exception(f'Error: {response.status_code}, {response.text}')
-            
-            data = response.json()
-            records.extend(data.get('records', []))
-            offset = data.get('offset')
-
-            if not offset:
-                break
-
-        return records
+        return list(self.tool.iter_base_records(
+            base_id, table_id_or_name, fields=fields, filter_by_formula=filter_by_formula,
+            sort=sort, view=view, max_records=max_records))
     
     @callable_function
+    @invalidates('records:{base_id}:{table_id_or_name}')
     def create_base_records(self, base_id: str, table_id_or_name: str, records: List[Dict[str, Any]]):
         """
         Create records in a table in your Airtable account
@@ -98,16 +185,12 @@ class Airtable(FunctionSet):
         :param records: A list of record objects to create.
         """
         url = f'https://api.airtable.com/v0/{base_id}/{table_id_or_name}'
-        headers = {
-            'Authorization': f'Bearer {self.token}',
-            'Content-Type': 'application/json'
-        }
         data = {
             'records': records
         }
 
-        response = requests.post(url, headers=headers, json=data)
+        response = self.tool.request('POST', url, base_id, json=data)
         if response.status_code != 200:
             return f'Error: {response.status_code}, {response.text}'
         
-        return f"Response: {response.json()}"
\ No newline at end of file
+        return response.json()
\ No newline at end of file
@@ -1,6 +1,8 @@
 from ..bases import FunctionSet, JSONSerializableFunction
+from ..utils import cacheable, invalidates
 import os
 from notion_client import Client, APIErrorCode, APIResponseError
+import httpx
 
 
 class Notion(FunctionSet):
@@ -24,14 +26,15 @@ class Notion(FunctionSet):
                 },
             }
 
+        @cacheable(ttl=60, tags=['notion'])
         def list_notion(self, title=""):
 
-            notion = Client(auth=os.environ["NOTION_TOKEN"])
+            notion = self.tool.client
 
             try:
                 response = notion.search(query=title)
 
-                return f"Listing everything in Notion{(', filtered by: ' + title) if title != '' else ''}. Response: {response}"
+                return response
             except APIResponseError as e:
                 return f"Error: {e}"
 
@@ -54,13 +57,14 @@ class Notion(FunctionSet):
                 },
             }
 
+        @cacheable(ttl=60, tags=['notion'])
         def query_notion_database(self, database_id):
-            notion = Client(auth=os.environ["NOTION_TOKEN"])
+            notion = self.tool.client
             try:
 
                 response = notion.databases.query(database_id=database_id)
 
-                return f"Querying database {database_id} in Notion. Response: {response}"
+                return response
 
             except APIResponseError as e:
                 return f"Error: {e}"
@@ -149,15 +153,16 @@ class Notion(FunctionSet):
                 },
             }
 
+        @invalidates('notion')
         def create_notion_page(self, parent_id, children={}, properties={}):
 
-            notion = Client(auth=os.environ["NOTION_TOKEN"])
+            notion = self.tool.client
 
             try:
                 created_page = notion.pages.create(
                     parent=parent_id, children=children, properties=properties)
 
-                return f"Creating page in Notion under {parent_id}. Response: {created_page}"
+                return created_page
             except APIResponseError as e:
                 return f"Error: {e}"
     
@@ -180,17 +185,20 @@ class Notion(FunctionSet):
                 },
             }
 
+        @cacheable(ttl=60, tags=['notion'])
         def read_notion_page(self, page_id):
-            notion = Client(auth=os.environ["NOTION_TOKEN"])
+            notion = self.tool.client
             try:
                 response = notion.pages.retrieve(page_id=page_id)
 
-                return f"Reading page {page_id} in Notion. Response: {response}"
+                return response
             except APIResponseError as e:
                 return f"Error: {e}"
 
-    def __init__(self, token=None, functions=None):
+    def __init__(self, token=None, functions=None, pool_size=None):
         self.token = token
+        if pool_size is not None:
+            self.pool_size = pool_size
 
         # try and load token from os.environ["NOTION_TOKEN"]
         if token is None:
@@ -214,3 +222,7 @@ class Notion(FunctionSet):
         # instantiate each class and add it to the class instance for the functions in the constructor
         self.functions = [self.functions_map[function]
                           (self) for function in functions]
+
+    def create_client(self):
+        limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+        return Client(auth=self.token, client=httpx.Client(limits=limits))
@@ -1,6 +1,80 @@
 from ..bases import FunctionSet, JSONSerializableFunction
-from openai import OpenAI as OpenAISDK
+from openai import OpenAI as OpenAISDK, DefaultHttpxClient
+from array import array
+import hashlib
+import sqlite3
+import threading
+import httpx
 import os
+import time
+
+
+class EmbeddingCache:
+    """Embeddings stored as float32 in SQLite, keyed by a hash of the model and text so each text is
+    only embedded once. Set INTO_EMBEDDING_CACHE to a file to keep embeddings between runs, otherwise
+    they are kept in memory. Caches are shared by every OpenAI tool using the same path.
+    The cache keeps up to max_entries embeddings, about 12 KB each for 3072 dimensions, and removes the
+    least recently used ones to make room"""
+
+    caches = {}
+    caches_lock = threading.Lock()
+    max_entries = 10000
+
+    def __init__(self, path=":memory:", max_entries=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB)")
+        # caches written before embeddings were evicted have no last used time
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(embeddings)")]
+        if "used" not in columns:
+            self.connection.execute("ALTER TABLE embeddings ADD COLUMN used REAL DEFAULT 0")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self.connection.commit()
+        self.count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, path=None):
+        path = os.path.expanduser(path or os.environ.get("INTO_EMBEDDING_CACHE") or ":memory:")
+        with cls.caches_lock:
+            if path not in cls.caches:
+                cls.caches[path] = cls(path)
+            return cls.caches[path]
+
+    @staticmethod
+    def key(model, text):
+        return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()[:32]
+
+    def get_many(self, keys):
+        """Return the vectors as float32 bytes, by key, for the keys that are in the cache"""
+        found = {}
+        keys = list(keys)
+        with self.lock, self.connection:
+            # SQLite limits the number of parameters of a query
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk)
+                found.update(rows)
+                self.connection.execute(
+                    f"UPDATE embeddings SET used = ? WHERE key IN ({placeholders})", [time.time(), *chunk])
+        return found
+
+    def set_many(self, model, vectors):
+        # only the last max_entries of a larger batch fit
+        items = list(vectors.items())[-self.max_entries:]
+        with self.lock, self.connection:
+            excess = self.count + len(items) - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)", (excess,))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, used) VALUES (?, ?, ?, ?)",
+                [(key, model, vector, time.time()) for key, vector in items])
+            self.count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
 
 class OpenAI(FunctionSet):
 
@@ -37,7 +111,7 @@ class OpenAI(FunctionSet):
         }
             
         def create_chat_completion(self, prompt, model="gpt-4o", system_prompt="You are a helpful assistant.", max_tokens=None):
-            client = OpenAISDK(api_key=self.tool.token)
+            client = self.tool.client
             completion = client.chat.completions.create(
                 model=model,
                 messages=[
@@ -57,13 +131,16 @@ class OpenAI(FunctionSet):
             self['type'] = "function"
             self['function'] = {
                 "name": "create_embedding",
-                "description": "Create an embedding using the OpenAI API. Embeddings are vectors that represent the meaning of text.",
+                "description": "Create embeddings using the OpenAI API. Embeddings are vectors that represent the meaning of text. Returns an ID for each embedding, and the embeddings are kept by the tool. To find texts by their meaning, use index_texts and semantic_search of the VectorIndex tool instead",
                 "parameters": {
                     "type": "object",
                     "properties": {
                         "input": {
-                            "type": "string",
-                            "description": "The text to embed",
+                            "anyOf": [
+                                {"type": "string"},
+                                {"type": "array", "items": {"type": "string"}},
+                            ],
+                            "description": "The text to embed, or a list of texts to embed together",
                         },
                         "model": {
                             "type": "string",
@@ -75,18 +152,30 @@ class OpenAI(FunctionSet):
             }
 
         def create_embedding(self, input, model="text-embedding-3-large"):
-            client = OpenAISDK(api_key=self.tool.token)
-            embedding = client.embeddings.create(
-                model=model,
-                input=input
-            )
-            response = embedding.data[0].embedding
+            texts = [input] if isinstance(input, str) else list(input)
+            keys, vectors = self.tool.embedding_vectors(texts, model)
+            # more texts than the cache holds push out the first ones, which have no ID
+            stored = self.tool.embedding_cache.get_many(set(keys))
 
-            return f"Created embedding using model {model} with input {input}. Response: {response}"
+            # the vectors are only useful to other tools, so the model only sees their IDs
+            result = {
+                "model": model,
+                "dimensions": len(vectors[keys[0]]) // 4 if keys else 0,
+                "embedding_ids": [f"emb_{key}" if key in stored else None for key in keys],
+            }
+            if len(stored) < len(vectors):
+                result["note"] = f"Only {len(stored)} of the embeddings fit in the cache, the others have no ID"
+            return result
 
-    
-    def __init__(self, token=None, functions=None):
+    # inputs per embeddings request, the limit of the API
+    embedding_batch_size = 2048
+    default_embedding_model = "text-embedding-3-large"
+
+    def __init__(self, token=None, functions=None, pool_size=None, embedding_cache=None):
         self.token = token
+        self.embedding_cache = EmbeddingCache.for_path(embedding_cache)
+        if pool_size is not None:
+            self.pool_size = pool_size
 
         # try and load the token from the environment
         if token is None:
@@ -105,4 +194,56 @@ class OpenAI(FunctionSet):
             functions = self.functions_map.keys()
 
         # instantiate each class and add it to the class instance for the functions in the constructor
-        self.functions = [self.functions_map[function](self) for function in functions]
\ No newline at end of file
+        self.functions = [self.functions_map[function](self) for function in functions]
+
+    def create_client(self):
+        limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+        return OpenAISDK(api_key=self.token, http_client=DefaultHttpxClient(limits=limits))
+
+    def embedding_vectors(self, texts, model=None):
+        """Embed the texts that aren't in the cache yet, in as few requests as possible, and return the
+        cache key of each text and a dict of the vector of each key. The vectors are kept in memory, as
+        the cache can remove some of them when there are more texts than it holds"""
+        model = model or self.default_embedding_model
+        keys = [self.embedding_cache.key(model, text) for text in texts]
+        vectors = self.embedding_cache.get_many(set(keys))
+
+        # embed each missing text once, even if it appears more than once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing[key] = text
+
+        missing_keys = list(missing)
+        for i in range(0, len(missing_keys), self.embedding_batch_size):
+            batch = missing_keys[i:i + self.embedding_batch_size]
+            response = self.client.embeddings.create(model=model, input=[missing[key] for key in batch])
+            embedded = {key: array('f', data.embedding).tobytes() for key, data in zip(batch, response.data)}
+            self.embedding_cache.set_many(model, embedded)
+            vectors.update(embedded)
+
+        return keys, vectors
+
+    def embed(self, input, model=None):
+        """Return the embedding of a text as a float32 NumPy array, or an array with a row for each
+        of a list of texts. Texts are embedded in batches and cached, see EmbeddingCache"""
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("embed needs numpy, install it with pip install interfaces-to[openai]")
+
+        texts = [input] if isinstance(input, str) else list(input)
+        keys, vectors = self.embedding_vectors(texts, model)
+        matrix = np.stack([np.frombuffer(vectors[key], dtype=np.float32) for key in keys]) if keys \
+            else np.empty((0, 0), dtype=np.float32)
+        return matrix[0] if isinstance(input, str) else matrix
+
+    def get_embedding(self, embedding_id):
+        """Return the embedding with an ID returned by create_embedding as a float32 NumPy array"""
+        import numpy as np
+
+        key = embedding_id.removeprefix("emb_")
+        vector = self.embedding_cache.get_many([key]).get(key)
+        if vector is None:
+            raise KeyError(f"Unknown embedding {embedding_id}")
+        return np.frombuffer(vector, dtype=np.float32).copy()
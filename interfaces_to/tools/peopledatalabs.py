@@ -1,12 +1,101 @@
 from typing import List, Dict, Any
 from ..bases import FunctionSet
-from ..utils import callable_function, tool_auth
+from ..utils import callable_function, tool_auth, cacheable, coalesce, cached_batch
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from peopledatalabs import PDLPY
 
 @tool_auth(token_env_name='PDL_API_KEY')
 class PeopleDataLabs(FunctionSet):
 
+    # the bulk endpoints take up to 100 people or companies per request
+    bulk_size = 100
+    max_concurrent_batches = 4
+
+    def __init__(self, token=None, functions=None, pool_size=None):
+        super().__init__(token, functions, pool_size)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def create_client(self):
+        return PDLPY(api_key=self.token)
+
+    def person_params(self, person):
+        # make a dict of the parameters that are not blank or None
+        params = {
+            "profile": person.get("profile_url"),
+            "email": person.get("email"),
+            "lid": person.get("linkedin_id"),
+            "phone": person.get("phone")
+        }
+        return {k: v for k, v in params.items() if v}
+
+    def company_params(self, company):
+        # a domain or name is needed, the ticker and profile only narrow the match
+        if not (company.get("domain") or company.get("company_name")):
+            return {}
+
+        params = {
+            "website": company.get("domain"),
+            "name": company.get("company_name"),
+            "ticker": company.get("ticker"),
+            "profile": company.get("profile_url")
+        }
+        return {k: v for k, v in params.items() if v}
+
+    def bulk(self, api, params_list):
+        """Enrich each of params_list with the bulk endpoint of api, client.person or client.company.
+        Batches of up to bulk_size are sent concurrently, and the matches are returned in the same order"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_concurrent_batches)
+
+        batches = [params_list[i:i + self.bulk_size] for i in range(0, len(params_list), self.bulk_size)]
+        futures = [self.executor.submit(self.bulk_batch, api, batch) for batch in batches]
+        return [match for future in futures for match in future.result()]
+
+    def bulk_batch(self, api, batch):
+        response = api.bulk(requests=[{"params": params} for params in batch]).json()
+
+        # errors for the whole request, e.g. an invalid API key, are returned as a single object
+        if isinstance(response, dict):
+            return [response] * len(batch)
+        return response
+
+    def enrich(self, api, params_list):
+        results = ["At least one of the parameters must be provided"] * len(params_list)
+        indexes = [i for i, params in enumerate(params_list) if params]
+        if not indexes:
+            return results
+
+        try:
+            matches = self.bulk(api, [params_list[i] for i in indexes])
+        except Exception as e:
+            matches = [f"Error: {e}"] * len(indexes)
+
+        for i, match in zip(indexes, matches):
+            results[i] = match
+        return results
+
+    def find_person_batch(self, people):
+        """Enrich the people of several find_person calls with bulk requests"""
+        return self.enrich(self.client.person, [self.person_params(person) for person in people])
+
+    def find_company_batch(self, companies):
+        """Enrich the companies of several find_company calls with bulk requests"""
+        return self.enrich(self.client.company, [self.company_params(company) for company in companies])
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
+    # profiles change slowly, and each enrichment is billed
     @callable_function
+    @coalesce('find_person_batch')
+    @cacheable(ttl=24 * 60 * 60, max_entries=1024)
     def find_person(self, profile_url: str=None, email: str=None, linkedin_id: str=None, phone: str=None):
         """
         Get details about a person using their LinkedIn/Facebook/Twitter/GitHub/Instagram/Indeed url, email address, LinkedIn ID or phone number
@@ -17,32 +106,23 @@ class PeopleDataLabs(FunctionSet):
         :param phone: The phone number of the person. For best results, use +[country code]. e.g. +1 555-234-1234
         """
 
+        params = self.tool.person_params(locals())
+
         # check that at least one of the parameters is provided
-        if not any([profile_url, email, linkedin_id, phone]):
+        if not params:
             return "At least one of the parameters must be provided"
 
-        client = PDLPY(api_key=self.token)
-
-        # make a dict of the parameters that are not None
-        params = {
-            "profile": profile_url,
-            "email": email,
-            "lid": linkedin_id,
-            "phone": phone
-        }
-
-        # remove the blank or None values from the params dict
-        params = {k: v for k, v in params.items() if v}
-        
         try:
             # get response by expanding params if the keys are not none
-            response = client.person.enrichment(**params).json()
+            response = self.tool.client.person.enrichment(**params).json()
 
-            return f"Response: {response}"
+            return response
         except Exception as e:
             return f"Error: {e}"
-    
+
     @callable_function
+    @coalesce('find_company_batch')
+    @cacheable(ttl=24 * 60 * 60, max_entries=1024)
     def find_company(self, domain: str=None, company_name: str=None, ticker: str=None, profile_url: str=None):
         """
         Get details about a company using their domain, company name, ticker symbol or social media profile
@@ -53,27 +133,35 @@ class PeopleDataLabs(FunctionSet):
         :param profile_url: The social profile url of the company e.g. linkedin.com/company/google
         """
 
+        params = self.tool.company_params(locals())
+
         # check that at least one of the parameters is provided
-        if not any([domain, company_name]):
+        if not params:
             return "At least one of the parameters must be provided"
 
-        client = PDLPY(api_key=self.token)
-
-        # make a dict of the parameters that are not None
-        params = {
-            "website": domain,
-            "name": company_name,
-            "ticker": ticker,
-            "profile": profile_url
-        }
-
-        # remove the blank or None values from the params dict
-        params = {k: v for k, v in params.items() if v}
-        
         try:
             # get response by expanding params if the keys are not none
-            response = client.company.enrichment(**params).json()
+            response = self.tool.client.company.enrichment(**params).json()
 
-            return f"Response: {response}"
+            return response
         except Exception as e:
-            return f"Error: {e}"
\ No newline at end of file
+            return f"Error: {e}"
+
+    @callable_function
+    def find_people(self, people: List[Dict[str, str]]):
+        """
+        Get details about many people at once. Use this instead of find_person when you have a list of people
+
+        :param people: The people to find, each with any of profile_url, email, linkedin_id and phone, e.g. [{"email": "renee.c.paulsen1959@yahoo.com"}, {"profile_url": "https://linkedin.com/in/seanthorne"}]
+        """
+        # people already found by find_person aren't enriched again
+        return cached_batch(PeopleDataLabs.find_person, self, self.tool.find_person_batch, people)
+
+    @callable_function
+    def find_companies(self, companies: List[Dict[str, str]]):
+        """
+        Get details about many companies at once. Use this instead of find_company when you have a list of companies
+
+        :param companies: The companies to find, each with a domain or company_name and optionally a ticker and profile_url, e.g. [{"domain": "google.com"}, {"company_name": "Google, Inc.", "ticker": "GOOGL"}]
+        """
+        return cached_batch(PeopleDataLabs.find_company, self, self.tool.find_company_batch, companies)
@@ -1,28 +1,121 @@
 from ..bases import FunctionSet, JSONSerializableFunction
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+import threading
+import time
 import os
 
+
+class ChannelDirectory:
+    """An index of the channels in a Slack workspace by name and ID. It is refreshed from all pages of
+    conversations.list when older than ttl seconds, and shared by every Slack tool and listener using
+    the same bot token"""
+
+    directories = {}
+    directories_lock = threading.Lock()
+
+    # events that change the channels in a workspace
+    events = ("channel_created", "channel_rename", "channel_deleted", "channel_archive", "channel_unarchive")
+
+    # wait at least this many seconds before refreshing again to look for an unknown channel
+    min_refresh_interval = 10
+
+    def __init__(self, token, ttl=300):
+        self.client = WebClient(token=token)
+        self.ttl = ttl
+        self.by_id = {}
+        self.by_name = {}
+        # never refreshed, so stale however long the host has been up
+        self.refreshed = float("-inf")
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    @classmethod
+    def for_token(cls, token, ttl=None):
+        with cls.directories_lock:
+            if token not in cls.directories:
+                cls.directories[token] = cls(token)
+            directory = cls.directories[token]
+        if ttl is not None:
+            directory.ttl = ttl
+        return directory
+
+    def refresh(self):
+        channels = []
+        cursor = None
+        while True:
+            response = self.client.conversations_list(limit=1000, cursor=cursor)
+            channels.extend(response["channels"])
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+
+        with self.lock:
+            self.by_id = {channel["id"]: channel for channel in channels}
+            self.by_name = {channel["name"]: channel for channel in channels}
+            self.refreshed = time.monotonic()
+
+    def refresh_if_older_than(self, seconds):
+        if time.monotonic() - self.refreshed > seconds:
+            with self.refresh_lock:
+                # another thread may have refreshed while this one was waiting
+                if time.monotonic() - self.refreshed > seconds:
+                    self.refresh()
+
+    def channels(self):
+        self.refresh_if_older_than(self.ttl)
+        return list(self.by_id.values())
+
+    def get(self, name=None, id=None):
+        """Return the channel with the given name or ID, or None if there isn't one"""
+        self.refresh_if_older_than(self.ttl)
+        channel = self.by_id.get(id) if id else self.by_name.get(name)
+
+        # the channel may have been created since the last refresh
+        if channel is None:
+            self.refresh_if_older_than(self.min_refresh_interval)
+            channel = self.by_id.get(id) if id else self.by_name.get(name)
+        return channel
+
+    def invalidate(self):
+        self.refreshed = float("-inf")
+
+    def apply_event(self, event):
+        """Update the directory from a Socket Mode channel event"""
+        channel = event.get("channel")
+        with self.lock:
+            if event["type"] == "channel_created":
+                self.by_id[channel["id"]] = channel
+                self.by_name[channel["name"]] = channel
+            elif event["type"] == "channel_rename" and channel["id"] in self.by_id:
+                existing = self.by_id[channel["id"]]
+                self.by_name.pop(existing["name"], None)
+                existing["name"] = channel["name"]
+                self.by_name[channel["name"]] = existing
+            elif event["type"] in ("channel_deleted", "channel_archive"):
+                existing = self.by_id.pop(channel, None)
+                if existing:
+                    self.by_name.pop(existing["name"], None)
+            else:
+                # e.g. channel_unarchive, the full channel isn't included so refresh on next use
+                self.refreshed = float("-inf")
+
+
 class Slack(FunctionSet):
 
     class SlackFunction(JSONSerializableFunction):
 
         def _join_channel(self, channel_id):
-            client = WebClient(token=self.tool.token)
+            client = self.tool.client
             try:
                 response = client.conversations_join(channel=channel_id)
                 return f"Joined channel {channel_id}"
             except SlackApiError as e:
                 return f"Error joining channel: {e.response['error']}"
-            
-        def _get_channels(self):
-            client = WebClient(token=self.tool.token)
-            try:
-                response = client.conversations_list()
-                channels = response["channels"]
-                return channels
-            except SlackApiError as e:
-                return f"Error retrieving channels: {e.response['error']}"
+
+        def _get_channel_id(self, channel_name):
+            channel = self.tool.channels.get(name=channel_name)
+            return channel["id"] if channel else None
 
     class ReadMessages(SlackFunction):
 
@@ -48,20 +141,17 @@ class Slack(FunctionSet):
             }
 
         def read_messages(self, channel_name="", channel_id=""):
-            client = WebClient(token=self.tool.token)
+            client = self.tool.client
             try:
-                channels = self._get_channels()
-                _channel = None
-                if channel_name != "":
-                    for c in channels:
-                        if c["name"] == channel_name:
-                            _channel = c
-                    channel_id = _channel["id"]
+                if channel_id == "" and channel_name != "":
+                    channel_id = self._get_channel_id(channel_name)
+                    if channel_id is None:
+                        return f"Error reading messages: channel {channel_name} not found"
                 if channel_id == "":
                     return f"Error reading messages: must provide channel name or channel id"
                 response = client.conversations_history(channel=channel_id)
                 messages = response["messages"]
-                return f"Messages: {messages}"
+                return {"messages": messages}
             except SlackApiError as e:
                 return f"Error reading messages: {e.response['error']}"
         
@@ -87,9 +177,10 @@ class Slack(FunctionSet):
             }
 
         def create_channel(self, channel):
-            client = WebClient(token=self.tool.token)
+            client = self.tool.client
             try:
                 response = client.conversations_create(name=channel)
+                self.tool.channels.invalidate()
                 return f"Channel {channel} created with ID {response['channel']['id']}"
             except SlackApiError as e:
                 return f"Error creating channel: {e.response['error']}"
@@ -115,14 +206,11 @@ class Slack(FunctionSet):
             }
 
         def list_channels(self, search=None):
-            client = WebClient(token=self.tool.token)
             try:
-                response = client.conversations_list()
-                channels = response["channels"]
+                channels = self.tool.channels.channels()
                 if search:
                     channels = [c for c in channels if search in c["name"]]
-                # return the list of channels as a string
-                return f"Channels: {channels}"
+                return {"channels": channels}
             except SlackApiError as e:
                 return f"Error listing channels: {e.response['error']}"
 
@@ -155,33 +243,17 @@ class Slack(FunctionSet):
             }
 
         def send_slack_message(self,  message, channel_name="", channel_id=""):
-            client = WebClient(token=self.tool.token)
-
-            # get channels
-            channels = self._get_channels()
-
-            # check if channel exists
-            _channel = None
-            if channel_name != "":
-                for c in channels:
-                    if c["name"] == channel_name:
-                        _channel = c
-                channel_id = _channel["id"]
-            if channel_id == "":
-                return f"Error reading messages: must provide channel name or channel id"
-
-            if channel_id == "":
-                return f"Channel {channel_id} not found"
-
-            for c in channels:
-                if c["id"] == channel_id:
-                    _channel = c
-
-            # join if not member
-            # if not _channel['is_member']:
-            #     self._join_channel(_channel['id'])
+            client = self.tool.client
 
             try:
+                # look up the channel only if its ID wasn't provided
+                if channel_id == "" and channel_name != "":
+                    channel_id = self._get_channel_id(channel_name)
+                    if channel_id is None:
+                        return f"Channel {channel_name} not found"
+                if channel_id == "":
+                    return f"Error sending message: must provide channel name or channel id"
+
                 response = client.chat_postMessage(
                     channel=channel_id,
                     text=message
@@ -191,8 +263,10 @@ class Slack(FunctionSet):
                 return f"Error sending message: {e.response['error']}"
 
 
-    def __init__(self, token=None, functions=None):
+    def __init__(self, token=None, functions=None, pool_size=None, channel_ttl=None):
         self.token = token
+        if pool_size is not None:
+            self.pool_size = pool_size
 
         # try and load token from os.environ["SLACK_BOT_TOKEN"]
         if token is None:
@@ -201,6 +275,9 @@ class Slack(FunctionSet):
             except KeyError:
                 raise ValueError("No token provided and SLACK_BOT_TOKEN not found in environment variables")
 
+        # channels are shared with other Slack tools and listeners using the same token
+        self.channels = ChannelDirectory.for_token(self.token, ttl=channel_ttl)
+
         # create a manual mapping of function names to classes
         self.functions_map = {
             'send_slack_message': Slack.SendSlackMessage,
@@ -214,3 +291,6 @@ class Slack(FunctionSet):
 
         # instantiate each class and add it to the class instance for the functions in the constructor
         self.functions = [self.functions_map[function](self) for function in functions]
+
+    def create_client(self):
+        return WebClient(token=self.token)
@@ -0,0 +1,148 @@
+from typing import List, Dict, Any
+from ..bases import FunctionSet
+from ..utils import callable_function, tool_auth
+from .openai import OpenAI
+import numpy as np
+import hashlib
+import threading
+import json
+import os
+
+
+@tool_auth(token_env_name='OPENAI_API_KEY')
+class VectorIndex(FunctionSet):
+    """A local index of texts for semantic search. Texts are embedded with the OpenAI tool, and their
+    normalized float32 vectors are appended to a memory-mapped file, so the index persists between runs.
+    Indexes are stored in the directory set by INTO_VECTOR_INDEX, ~/.cache/interfaces_to/vector_index by default"""
+
+    default_model = "text-embedding-3-small"
+
+    def __init__(self, token=None, functions=None, pool_size=None, name="default", path=None, model=None):
+        super().__init__(token, functions, pool_size)
+        root = path or os.environ.get("INTO_VECTOR_INDEX") or "~/.cache/interfaces_to/vector_index"
+        self.path = os.path.join(os.path.expanduser(root), name)
+        self.model = model or self.default_model
+        self.lock = threading.Lock()
+        self.load()
+
+    def create_client(self):
+        # the OpenAI tool embeds the texts, and caches their embeddings
+        return OpenAI(token=self.token, pool_size=self.pool_size)
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+        self.texts_path = os.path.join(self.path, "texts.jsonl")
+        meta_path = os.path.join(self.path, "meta.json")
+
+        self.dimensions = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.dimensions = meta["dimensions"]
+            self.model = meta["model"]
+
+        self.entries = []
+        if os.path.exists(self.texts_path):
+            with open(self.texts_path, encoding="utf-8") as f:
+                self.entries = [json.loads(line) for line in f if line.strip()]
+
+        # an interrupted append may have written a vector without its text, or the other way around
+        rows = os.path.getsize(self.vectors_path) // (4 * self.dimensions) \
+            if self.dimensions and os.path.exists(self.vectors_path) else 0
+        self.count = min(rows, len(self.entries))
+        self.rewrite_texts = len(self.entries) != self.count or not self.count
+        self.entries = self.entries[:self.count]
+        self.ids = {entry["id"]: i for i, entry in enumerate(self.entries)}
+        self.matrix = None
+
+    def vectors(self):
+        """The vectors of the index as a read-only memory-mapped array, mapped again after each append"""
+        if self.matrix is None and self.count:
+            self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                    shape=(self.count, self.dimensions))
+        return self.matrix
+
+    def add(self, texts, metadata=None, ids=None):
+        """Embed and append texts to the index, skipping those whose ID is already indexed.
+        The ID of a text is a hash of its content unless ids are given"""
+        metadata = metadata or [{}] * len(texts)
+        ids = ids or [hashlib.sha256(text.encode()).hexdigest()[:16] for text in texts]
+        if len(metadata) != len(texts) or len(ids) != len(texts):
+            raise ValueError(f"got {len(texts)} texts, but {len(metadata)} metadata and {len(ids)} ids")
+
+        new = {}
+        for id, text, meta in zip(ids, texts, metadata):
+            if id not in self.ids and id not in new:
+                new[id] = {"id": id, "text": text, "metadata": meta or {}}
+        if not new:
+            return 0
+
+        vectors = self.client.embed([entry["text"] for entry in new.values()], model=self.model)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self.lock:
+            if self.dimensions is None:
+                self.dimensions = vectors.shape[1]
+                with open(os.path.join(self.path, "meta.json"), "w") as f:
+                    json.dump({"dimensions": self.dimensions, "model": self.model}, f)
+
+            # write past any partial append, so the vectors and texts stay in step
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(self.count * self.dimensions * 4)
+                f.write(vectors.astype(np.float32).tobytes())
+            written = self.entries + list(new.values()) if self.rewrite_texts else new.values()
+            with open(self.texts_path, "w" if self.rewrite_texts else "a", encoding="utf-8") as f:
+                for entry in written:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.rewrite_texts = False
+
+            for entry in new.values():
+                self.ids[entry["id"]] = len(self.entries)
+                self.entries.append(entry)
+            self.count = len(self.entries)
+            self.matrix = None
+        return len(new)
+
+    def search(self, query, top_k=5, min_score=None):
+        """Return the top_k entries most similar to query by cosine similarity, best first"""
+        with self.lock:
+            vectors, entries = self.vectors(), self.entries
+        if vectors is None:
+            return []
+
+        query = self.client.embed(query, model=self.model)
+        scores = vectors @ (query / max(np.linalg.norm(query), 1e-12))
+
+        top_k = min(top_k, len(scores))
+        if top_k < 1:
+            return []
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+
+        return [{**entries[i], "score": round(float(scores[i]), 4)}
+                for i in top if min_score is None or scores[i] >= min_score]
+
+    @callable_function
+    def index_texts(self, texts: List[str], metadata: List[Dict[str, Any]] = None):
+        """
+        Add texts to your local index, so you can find them later with semantic_search. Texts that are already indexed are skipped
+
+        :param texts: The texts to index, e.g. Slack messages or the contents of Notion pages
+        :param metadata: Optional details to keep with each text, one for each text in the same order, e.g. [{"channel": "general", "ts": "1721303012.000200"}]
+        """
+        if metadata and len(metadata) != len(texts):
+            return f"Error: metadata has {len(metadata)} items, but there are {len(texts)} texts. Give one for each text, or none"
+        indexed = self.tool.add(texts, metadata)
+        return {"indexed": indexed, "skipped": len(texts) - indexed, "total": self.tool.count}
+
+    @callable_function
+    def semantic_search(self, query: str, top_k: int = 5, min_score: float = None):
+        """
+        Find the texts in your local index with the most similar meaning to a query
+
+        :param query: What to search for, e.g. "decisions about the launch date"
+        :param top_k: The number of texts to return
+        :param min_score: Only return texts with at least this cosine similarity, from -1 to 1
+        """
+        return {"results": self.tool.search(query, top_k, min_score)}
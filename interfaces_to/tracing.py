@@ -0,0 +1,204 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+
+class Span:
+    """A timed step of an agent turn: an llm call, a tool call, a wait in a listener's queue, rendering a
+    message, or the whole turn. Hooks are called with each span when it ends"""
+
+    enabled = True
+
+    def __init__(self, kind, name=None, turn_id=None, **attributes):
+        self.kind = kind
+        self.name = name
+        self.turn_id = turn_id
+        self.attributes = attributes
+        self.error = None
+        self.start = time.time()
+        self.duration = None
+        self.started = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "name": self.name,
+            "turn_id": self.turn_id,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            **self.attributes,
+        }
+
+
+class NullSpan:
+    """Stands in for a span when there are no hooks, so tracing costs almost nothing"""
+
+    enabled = False
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_span = NullSpan()
+
+
+class SpanContext:
+
+    def __init__(self, tracer, span):
+        self.tracer = tracer
+        self.span = span
+
+    def __enter__(self):
+        return self.span
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.span.duration = time.perf_counter() - self.span.started
+        if exc is not None:
+            self.span.error = f"{exc_type.__name__}: {exc}"
+        self.tracer.emit(self.span)
+        return False
+
+
+class Tracer:
+    """Sends spans to hooks, which are callables taking a Span, e.g. JSONLExporter("trace.jsonl").
+    With no hooks, span() returns a shared no-op span"""
+
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks or [])
+
+    def __bool__(self):
+        return bool(self.hooks)
+
+    def span(self, kind, name=None, turn_id=None, **attributes):
+        if not self.hooks:
+            return null_span
+        return SpanContext(self, Span(kind, name, turn_id, **attributes))
+
+    def record(self, kind, name=None, duration=0.0, turn_id=None, **attributes):
+        """Emit a span that has already been timed, e.g. a wait measured elsewhere"""
+        if not self.hooks:
+            return
+        span = Span(kind, name, turn_id, **attributes)
+        span.start -= duration
+        span.duration = duration
+        self.emit(span)
+
+    def turn(self, turn_id=None):
+        """A tracer whose spans all belong to one turn"""
+        if not self.hooks:
+            return self
+        return TurnTracer(self, turn_id or uuid.uuid4().hex[:12])
+
+    def emit(self, span):
+        for hook in self.hooks:
+            try:
+                hook(span)
+            except Exception as e:
+                logging.error(f"Error in tracing hook: {e}")
+
+
+class TurnTracer(Tracer):
+
+    def __init__(self, tracer, turn_id):
+        self.hooks = tracer.hooks
+        self.turn_id = turn_id
+
+    def span(self, kind, name=None, turn_id=None, **attributes):
+        return super().span(kind, name, turn_id or self.turn_id, **attributes)
+
+    def record(self, kind, name=None, duration=0.0, turn_id=None, **attributes):
+        return super().record(kind, name, duration, turn_id or self.turn_id, **attributes)
+
+    def turn(self, turn_id=None):
+        return self if turn_id is None else TurnTracer(self, turn_id)
+
+
+# used when tracing isn't set up
+null_tracer = Tracer()
+
+
+def as_tracer(hooks):
+    """Return a Tracer for hooks, which can be None, a Tracer, a callable or a list of callables"""
+    if hooks is None:
+        return null_tracer
+    if isinstance(hooks, Tracer):
+        return hooks
+    if callable(hooks):
+        return Tracer([hooks])
+    return Tracer(hooks)
+
+
+def size_of(value):
+    # the size in characters of a message, arguments or tool result
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value)
+    return len(json.dumps(value, ensure_ascii=False, default=str))
+
+
+class JSONLExporter:
+    """A hook that appends each span to a file as a line of JSON"""
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class OpenTelemetryExporter:
+    """A hook that sends each span to OpenTelemetry. Requires opentelemetry-api, and an SDK configured with
+    an exporter, e.g. pip install interfaces-to[opentelemetry]"""
+
+    def __init__(self, tracer_provider=None):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ImportError("OpenTelemetryExporter needs opentelemetry-api, install it with pip install interfaces-to[opentelemetry]")
+
+        self.trace = trace
+        self.tracer = trace.get_tracer("interfaces_to", tracer_provider=tracer_provider)
+
+    def __call__(self, span):
+        attributes = {"into.kind": span.kind, "into.turn_id": span.turn_id or ""}
+        for key, value in span.attributes.items():
+            # OpenTelemetry only accepts simple attribute values
+            attributes[f"into.{key}"] = value if isinstance(value, (str, bool, int, float)) else str(value)
+
+        start = int(span.start * 1e9)
+        otel_span = self.tracer.start_span(f"{span.kind} {span.name}" if span.name else span.kind,
+                                           start_time=start, attributes=attributes)
+        if span.error:
+            otel_span.set_status(self.trace.Status(self.trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=start + int((span.duration or 0) * 1e9))
+
+
+def completion_attributes(completion):
+    # the token usage of a completion, which streams only have once they are read
+    attributes = {}
+    usage = getattr(completion, "usage", None)
+    if usage is not None:
+        attributes["prompt_tokens"] = getattr(usage, "prompt_tokens", None)
+        attributes["completion_tokens"] = getattr(usage, "completion_tokens", None)
+    return attributes
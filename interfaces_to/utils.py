@@ -1,132 +1,703 @@
-import pkg_resources
-from packaging.version import parse as parse_version
-from packaging.specifiers import SpecifierSet
-from pydantic import create_model
 from typing import get_type_hints
 import inspect
-from .bases import JSONSerializableFunction, Messages
-from docstring_parser import parse
+from .bases import JSONSerializableFunction, Messages, ToolRegistry, ToolCache, estimate_tokens
+from .tracing import as_tracer, null_tracer, size_of
 import json
+import copy
+import hashlib
 import importlib
+import importlib.metadata
+import functools
 import os
+import sys
+import time
+import asyncio
+import atexit
+import threading
+from collections import deque
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+def run(messages, completion, tools, parallel_tool_calls=False, max_workers=None, timeout=None, shaper=None,
+        hooks=None, turn_id=None):
+    """Append the completion and the output of its tool calls to messages.
+    Set parallel_tool_calls=True to run the tool calls of each choice concurrently on a thread pool
+    of max_workers threads, waiting up to timeout seconds for each call.
+    Tool results are written by shaper, a ResultShaper, to keep them within a token budget.
+    hooks are called with a Span for each tool call, see tracing.py, and turn_id groups the spans of a turn.
+    completion can also be a stream created with stream=True, see run_stream"""
+    tracer = as_tracer(hooks).turn(turn_id)
+    if not hasattr(completion, 'choices'):
+        return run_stream(messages, completion, tools, parallel_tool_calls, max_workers, timeout, shaper, tracer)
+
+    tools = bind_tools(messages, tools)
 
+    for choice in completion.choices:
+        if choice.message.content or hasattr(choice.message, 'tool_calls'):
+            assistant_message, tool_calls = create_assistant_message(choice, tools)
+            messages.append(assistant_message)
+
+            results = call_tools(tools, tool_calls, parallel_tool_calls, max_workers, timeout, tracer,
+                                 getattr(messages, 'journal', None))
+            append_tool_messages(messages, tool_calls, results, shaper)
+
+    update_system_message(messages, tools)
+
+    return messages
 
-def run(messages, completion, tools):
-    for tool in tools:
-        if isinstance(messages, Messages):
-            tool.system = messages.system
-        tool.tools = tools
 
-    tool_map = {json.loads(json.dumps(tool))[
-        "function"]["name"]: tool for tool in tools}
+async def arun(messages, completion, tools, timeout=None, shaper=None, hooks=None, turn_id=None):
+    """Async version of run. Tool calls of each choice are always run concurrently with asyncio.gather,
+    waiting up to timeout seconds for each call"""
+    tracer = as_tracer(hooks).turn(turn_id)
+    if not hasattr(completion, 'choices'):
+        return await arun_stream(messages, completion, tools, timeout, shaper, tracer)
+
+    tools = bind_tools(messages, tools)
 
     for choice in completion.choices:
         if choice.message.content or hasattr(choice.message, 'tool_calls'):
-            assistant_message = {
-                "role": "assistant",
-                "content": choice.message.content,
-            }
+            assistant_message, tool_calls = create_assistant_message(choice, tools)
+            messages.append(assistant_message)
+
+            results = await acall_tools(tools, tool_calls, timeout, tracer, getattr(messages, 'journal', None))
+            append_tool_messages(messages, tool_calls, results, shaper)
+
+    update_system_message(messages, tools)
+
+    return messages
+
 
-            # Check if tool_calls is not None and is iterable
-            if hasattr(choice.message, 'tool_calls') and choice.message.tool_calls:
-                assistant_message["tool_calls"] = []
+def run_stream(messages, stream, tools, parallel_tool_calls=False, max_workers=None, timeout=None, shaper=None,
+               hooks=None, turn_id=None):
+    """Append a streamed completion and the output of its tool calls to messages.
+    Each tool call starts as soon as its arguments are complete, while the rest of the completion is
+    still streaming. Unless parallel_tool_calls=True, tool calls are started one at a time in order"""
+    tools = bind_tools(messages, tools)
+    tracer = as_tracer(hooks).turn(turn_id)
+    journal = getattr(messages, 'journal', None)
+
+    executor = ThreadPoolExecutor(max_workers=(max_workers if parallel_tool_calls else 1))
+    try:
+        choices = {}
+        # the rest of the completion is generated while the stream is read
+        with tracer.span("stream") as span:
+            for chunk in stream:
+                for choice in chunk.choices:
+                    message = choices.setdefault(choice.index, StreamedMessage())
+                    stream_token(messages, choice)
+                    for tool_call in message.add(choice.delta):
+                        if tool_call.function.name in tools.functions:
+                            tool_call.start(submit_tool(executor, call_tool, tools, tool_call, tracer, journal))
+            if span.enabled:
+                span.set(content_size=sum(len(message.content or "") for message in choices.values()))
+
+        for index in sorted(choices):
+            message = choices[index]
+            if message.content or message.tool_calls:
+                assistant_message, tool_calls = create_assistant_message(message.choice(), tools)
+                messages.append(assistant_message)
+
+                # start any tool calls whose arguments could not be parsed, so they fail as they do in run
+                for tool_call in tool_calls:
+                    if tool_call.future is None:
+                        tool_call.start(submit_tool(executor, call_tool, tools, tool_call, tracer, journal))
+
+                results = wait_for_tools(tool_calls, [tool_call.future for tool_call in tool_calls], timeout)
+                append_tool_messages(messages, tool_calls, results, shaper)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    update_system_message(messages, tools)
+
+    return messages
 
-                for tool_call in choice.message.tool_calls:
-                    assistant_message["tool_calls"].append({
-                        "id": tool_call.id,
-                        "type": tool_call.type,
-                        "function": {
-                            "name": tool_call.function.name,
-                            "arguments": tool_call.function.arguments
-                        }
-                    })
 
+async def arun_stream(messages, stream, tools, timeout=None, shaper=None, hooks=None, turn_id=None):
+    """Async version of run_stream, for streams created by AsyncOpenAI"""
+    tools = bind_tools(messages, tools)
+    tracer = as_tracer(hooks).turn(turn_id)
+    journal = getattr(messages, 'journal', None)
+
+    choices = {}
+    with tracer.span("stream") as span:
+        async for chunk in stream:
+            for choice in chunk.choices:
+                message = choices.setdefault(choice.index, StreamedMessage())
+                stream_token(messages, choice)
+                for tool_call in message.add(choice.delta):
+                    if tool_call.function.name in tools.functions:
+                        tool_call.start(asyncio.create_task(acall_tool(tools, tool_call, timeout, tracer, journal)))
+        if span.enabled:
+            span.set(content_size=sum(len(message.content or "") for message in choices.values()))
+
+    for index in sorted(choices):
+        message = choices[index]
+        if message.content or message.tool_calls:
+            assistant_message, tool_calls = create_assistant_message(message.choice(), tools)
             messages.append(assistant_message)
 
-            if hasattr(choice.message, 'tool_calls') and choice.message.tool_calls:
-                for tool_call in choice.message.tool_calls:
-                    tool_name = tool_call.function.name
-                    if tool_name in tool_map:
-                        tool = tool_map[tool_name]
-                        parameters = json.loads(tool_call.function.arguments)
-                        result = getattr(tool, tool_name)(**parameters)
-                        # Append the tool's action as a message
-                        messages.append({
-                            "role": "tool",
-                            "content": result,
-                            "tool_call_id": tool_call.id
-                        })
-
-
-    # check if System is in tools
-    if 'set_system_message' in tool_map or 'clear_system_message' in tool_map:
-        # check if the System tool .system is different from system
-        if tool_map['set_system_message'].system != messages.system:
-            # modify the system message in messages
-            messages.system = tool_map['set_system_message'].system
-        elif tool_map['clear_system_message'].system != messages.system:
-            # clear the system message in messages
-            messages.system = tool_map['clear_system_message'].system
+            for tool_call in tool_calls:
+                if tool_call.future is None:
+                    tool_call.start(asyncio.create_task(acall_tool(tools, tool_call, timeout, tracer, journal)))
+
+            results = await asyncio.gather(*(tool_call.future for tool_call in tool_calls))
+            append_tool_messages(messages, tool_calls, results, shaper)
 
+    update_system_message(messages, tools)
 
     return messages
 
 
-def print_message(message):
+def stream_token(messages, choice):
+    # let listeners show the first choice's content as it is generated
+    if choice.index == 0 and choice.delta.content and isinstance(messages, Messages):
+        messages.stream_token(choice.delta.content)
+
+
+def unanswered_tool_calls(messages):
+    """The tool calls of the last assistant message that have no tool message yet, e.g. because the
+    process stopped or a tool raised while they were running"""
+    for index in range(len(messages) - 1, -1, -1):
+        message = messages[index]
+        if message['role'] == 'assistant':
+            if not message.get('tool_calls'):
+                return []
+            answered = set(reply.get('tool_call_id') for reply in messages[index + 1:])
+            return [tool_call for tool_call in message['tool_calls'] if tool_call['id'] not in answered]
+        if message['role'] != 'tool':
+            return []
+    return []
+
+
+def pending_tool_calls(messages, tools):
+    """The unanswered tool calls that can be run with tools"""
+    return [SimpleNamespace(id=tool_call['id'], type=tool_call.get('type', 'function'),
+                            function=SimpleNamespace(**tool_call['function']))
+            for tool_call in unanswered_tool_calls(messages)
+            if tool_call['function']['name'] in tools.functions]
+
+
+def resume_tool_calls(messages, tools, parallel_tool_calls=False, max_workers=None, timeout=None, shaper=None,
+                      results=None):
+    """Run the tool calls that were interrupted, and append their tool messages. Tool calls that already
+    have a tool message, or a result in results, aren't run again"""
+    tools = bind_tools(messages, tools)
+    results = results or {}
+    tool_calls = pending_tool_calls(messages, tools)
+    if tool_calls:
+        interrupted = [tool_call for tool_call in tool_calls if tool_call.id not in results]
+        new_results = call_tools(tools, interrupted, parallel_tool_calls, max_workers, timeout,
+                                 journal=getattr(messages, 'journal', None))
+        results = {**results, **{tool_call.id: result for tool_call, result in zip(interrupted, new_results)}}
+        append_tool_messages(messages, tool_calls, [results[tool_call.id] for tool_call in tool_calls], shaper)
+        update_system_message(messages, tools)
+    return messages
+
+
+class StreamedToolCall:
+    """A tool call assembled from the deltas of a streamed completion"""
+
+    def __init__(self, id=None, type="function"):
+        self.id = id
+        self.type = type
+        self.function = SimpleNamespace(name="", arguments="")
+        self.future = None
+
+    def add(self, delta):
+        """Add a delta and return True once the arguments are complete JSON"""
+        if delta.id:
+            self.id = delta.id
+        if delta.type:
+            self.type = delta.type
+        if delta.function is not None:
+            if delta.function.name:
+                self.function.name += delta.function.name
+            if delta.function.arguments:
+                self.function.arguments += delta.function.arguments
+
+        # only try to parse the arguments when they could be complete
+        if self.future is not None or not self.function.arguments.rstrip().endswith('}'):
+            return False
+        try:
+            json.loads(self.function.arguments)
+            return True
+        except json.JSONDecodeError:
+            return False
+
+    def start(self, future):
+        self.future = future
+
+
+class StreamedMessage:
+    """A message assembled from the deltas of a streamed completion"""
+
+    def __init__(self):
+        self.content_parts = []
+        self.tool_calls_by_index = {}
 
-    # Define ANSI escape codes for colors
-    role_colors = {
-        'user': '\033[92m',  # Green
-        'system': '\033[90m', # Grey
-        'tool': '\033[94m',  # Blue
-        'assistant': '\033[93m',  # Yellow
-        'reset': '\033[0m'   # Reset
+    @property
+    def content(self):
+        return ''.join(self.content_parts) if self.content_parts else None
+
+    @property
+    def tool_calls(self):
+        return [self.tool_calls_by_index[index] for index in sorted(self.tool_calls_by_index)]
+
+    def add(self, delta):
+        """Add a delta and return the tool calls whose arguments are now complete"""
+        if delta.content:
+            self.content_parts.append(delta.content)
+
+        complete = []
+        for tool_call_delta in getattr(delta, 'tool_calls', None) or []:
+            tool_call = self.tool_calls_by_index.setdefault(tool_call_delta.index, StreamedToolCall())
+            if tool_call.add(tool_call_delta):
+                complete.append(tool_call)
+        return complete
+
+    def choice(self):
+        return SimpleNamespace(message=self)
+
+
+def bind_tools(messages, tools):
+    """Return tools as a ToolRegistry, giving each tool access to the system message"""
+    if not isinstance(tools, ToolRegistry):
+        tools = ToolRegistry(tools)
+
+    if isinstance(messages, Messages):
+        tools.bind_system(messages.system)
+
+    return tools
+
+
+def create_assistant_message(choice, tools):
+    """Return the assistant message for a choice, and the tool calls that can be run with tools"""
+    assistant_message = {
+        "role": "assistant",
+        "content": choice.message.content,
     }
 
-    tool_calls_message = True if 'tool_calls' in message else False
+    # Check if tool_calls is not None and is iterable
+    if not (hasattr(choice.message, 'tool_calls') and choice.message.tool_calls):
+        return assistant_message, []
+
+    assistant_message["tool_calls"] = []
+
+    for tool_call in choice.message.tool_calls:
+        assistant_message["tool_calls"].append({
+            "id": tool_call.id,
+            "type": tool_call.type,
+            "function": {
+                "name": tool_call.function.name,
+                "arguments": tool_call.function.arguments
+            }
+        })
+
+    tool_calls = [tool_call for tool_call in choice.message.tool_calls
+                  if tool_call.function.name in tools.functions]
+
+    return assistant_message, tool_calls
+
+
+def append_tool_messages(messages, tool_calls, results, shaper=None):
+    contents = (shaper or default_shaper).shape(tool_calls, results)
+    for tool_call, content in zip(tool_calls, contents):
+        # Append the tool's action as a message
+        messages.append({
+            "role": "tool",
+            "content": content,
+            "tool_call_id": tool_call.id
+        })
+
+
+class ResultShaper:
+    """Turns tool results into the content of tool messages.
+    Results that aren't strings are written as compact JSON, without the fields in exclude_fields, e.g.
+    {"read_messages": ["blocks"]} or {"*": ["icon"]} for every tool. Each result is then truncated to
+    max_tokens, or tool_max_tokens[tool_name], and all results of one turn together to total_max_tokens.
+    Pass count_tokens to count tokens with a real tokenizer, e.g. tiktoken"""
+
+    truncated_marker = "...[truncated {dropped} of {tokens} tokens]"
+
+    def __init__(self, max_tokens=None, tool_max_tokens=None, total_max_tokens=None,
+                 exclude_fields=None, count_tokens=None):
+        self.max_tokens = max_tokens
+        self.tool_max_tokens = tool_max_tokens or {}
+        self.total_max_tokens = total_max_tokens
+        self.exclude_fields = exclude_fields or {}
+        self.count_tokens = count_tokens or estimate_tokens
+
+    def serialize(self, tool_name, result):
+        if isinstance(result, str):
+            return result
+
+        exclude = set(self.exclude_fields.get('*', [])) | set(self.exclude_fields.get(tool_name, []))
+        if exclude:
+            result = self.project(result, exclude)
+        return json.dumps(result, separators=(',', ':'), ensure_ascii=False, default=str)
+
+    def project(self, value, exclude):
+        # drop the excluded fields at any depth
+        if isinstance(value, dict):
+            return {key: self.project(item, exclude) for key, item in value.items() if key not in exclude}
+        if isinstance(value, (list, tuple)):
+            return [self.project(item, exclude) for item in value]
+        return value
+
+    def truncate(self, content, max_tokens):
+        tokens = self.count_tokens(content)
+        if max_tokens is None or tokens <= max_tokens:
+            return content
+
+        # keep the same share of characters as of tokens, leaving room for the marker
+        marker = self.truncated_marker.format(dropped=tokens - max_tokens, tokens=tokens)
+        keep = max(int(len(content) * max_tokens / tokens) - len(marker), 0)
+        return content[:keep] + marker
+
+    def budgets(self, sizes):
+        """Share total_max_tokens between results so that small results are kept whole and
+        large results are cut to the same size"""
+        budgets = list(sizes)
+        if self.total_max_tokens is None or sum(sizes) <= self.total_max_tokens:
+            return budgets
+
+        remaining = self.total_max_tokens
+        order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+        for position, i in enumerate(order):
+            share = remaining // (len(order) - position)
+            budgets[i] = min(sizes[i], share)
+            remaining -= budgets[i]
+        return budgets
+
+    def shape(self, tool_calls, results):
+        contents = []
+        for tool_call, result in zip(tool_calls, results):
+            name = tool_call.function.name
+            content = self.serialize(name, result)
+            contents.append(self.truncate(content, self.tool_max_tokens.get(name, self.max_tokens)))
+
+        budgets = self.budgets([self.count_tokens(content) for content in contents])
+        return [self.truncate(content, budget) for content, budget in zip(contents, budgets)]
+
+
+# only turns results into compact JSON, without budgets
+default_shaper = ResultShaper()
+
+
+def update_system_message(messages, tools):
+    # check if the System tool has set or cleared the system message
+    for tool_name in ('set_system_message', 'clear_system_message'):
+        tool = tools.tool_map.get(tool_name)
+        if tool is not None and tool.system != messages.system:
+            # modify the system message in messages
+            messages.system = tool.system
+            break
+
+
+def call_tool(tools, tool_call, tracer=null_tracer, journal=None):
+    with tracer.span("tool", tool_call.function.name, args_size=len(tool_call.function.arguments or "")) as span:
+        result = _call_tool(tools, tool_call)
+        if span.enabled:
+            trace_result(span, result)
+    if journal:
+        journal.result(tool_call.id, result)
+    return result
+
+
+def trace_result(span, result):
+    span.set(result_size=size_of(result))
+    # tools report most errors by returning them
+    if is_error(result):
+        span.error = result
+
+
+def _call_tool(tools, tool_call):
+    parameters = json.loads(tool_call.function.arguments)
+    result = tools.functions[tool_call.function.name](**parameters)
+
+    # async functions can also be called from the sync run
+    if inspect.isawaitable(result):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(result)
+        # an event loop is already running in this thread (e.g. in Jupyter), so use another one
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, result).result()
+
+    return result
+
+
+def call_tools(tools, tool_calls, parallel=False, max_workers=None, timeout=None, tracer=null_tracer, journal=None):
+    """Call each tool and return the results in the same order as tool_calls.
+    Several calls of a function marked with coalesce are made as one call of its batch method.
+    Each result is written to journal as soon as it returns"""
+    batches = coalesce_tool_calls(tools, tool_calls)
+    # a single call only needs a thread for its timeout
+    if not parallel or not batches or (len(batches) == 1 and timeout is None):
+        return scatter_results(tool_calls, batches, [call_batch(tools, batch, tracer, journal) for batch in batches])
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(batches))
+    try:
+        futures = [submit_tool(executor, call_batch, tools, batch, tracer, journal) for batch in batches]
+        results = wait_for_tools([batch[0] for batch in batches], futures, timeout)
+        return scatter_results(tool_calls, batches, results)
+    finally:
+        # don't wait for tool calls that timed out, their threads finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def coalesce_tool_calls(tools, tool_calls):
+    """Group the calls of each function marked with coalesce, every other call is in a group of its own"""
+    batches = []
+    batches_by_name = {}
+    for tool_call in tool_calls:
+        name = tool_call.function.name
+        if getattr(tools.functions[name], '_coalesce', None) is None:
+            batches.append([tool_call])
+        elif name in batches_by_name:
+            batches_by_name[name].append(tool_call)
+        else:
+            batches_by_name[name] = [tool_call]
+            batches.append(batches_by_name[name])
+    return batches
+
+
+def call_batch(tools, batch, tracer=null_tracer, journal=None):
+    """Call a group of tool calls and return a result for each"""
+    if len(batch) == 1:
+        return [call_tool(tools, batch[0], tracer, journal)]
+
+    function = tools.functions[batch[0].function.name]
+    batch_method = getattr(function.__self__.tool, function._coalesce)
+    with tracer.span("tool", batch[0].function.name, batch_size=len(batch),
+                     args_size=sum(len(tool_call.function.arguments or "") for tool_call in batch)) as span:
+        arguments = [json.loads(tool_call.function.arguments) for tool_call in batch]
+        results = cached_batch(function, function.__self__, batch_method, arguments)
+        if span.enabled:
+            span.set(result_size=size_of(results))
+    if journal:
+        for tool_call, result in zip(batch, results):
+            journal.result(tool_call.id, result)
+    return results
+
+
+def scatter_results(tool_calls, batches, batch_results):
+    results = {}
+    for batch, batch_result in zip(batches, batch_results):
+        # a batch that timed out has one error message for all its calls
+        if isinstance(batch_result, str):
+            batch_result = [batch_result] * len(batch)
+        for tool_call, result in zip(batch, batch_result):
+            results[id(tool_call)] = result
+    return [results[id(tool_call)] for tool_call in tool_calls]
+
+
+def submit_tool(executor, function, *args):
+    """Submit a tool call to executor. The future's started event is set when the call starts running,
+    so its timeout doesn't include the time it waited for a free worker"""
+    started = threading.Event()
+
+    def run():
+        started.at = time.monotonic()
+        started.set()
+        return function(*args)
+
+    future = executor.submit(run)
+    future.started = started
+    return future
+
+
+def wait_for_tools(tool_calls, futures, timeout=None):
+    """Wait for each future and return the results in the same order as tool_calls. Each call has timeout
+    seconds from when it starts running, and a call still waiting for a worker timeout seconds after the
+    calls before it have finished or timed out has timed out too"""
+    results = []
+    for tool_call, future in zip(tool_calls, futures):
+        try:
+            if timeout is not None and not future.started.wait(timeout):
+                raise FutureTimeoutError()
+            remaining = max(0, future.started.at + timeout - time.monotonic()) if timeout is not None else None
+            results.append(future.result(timeout=remaining))
+        except FutureTimeoutError:
+            future.cancel()
+            results.append(
+                f"Error: tool call {tool_call.function.name} timed out after {timeout} seconds")
+    return results
+
+
+async def acall_tool(tools, tool_call, timeout=None, tracer=null_tracer, journal=None):
+    with tracer.span("tool", tool_call.function.name, args_size=len(tool_call.function.arguments or "")) as span:
+        try:
+            result = await asyncio.wait_for(_acall_tool(tools, tool_call), timeout)
+        except asyncio.TimeoutError:
+            result = f"Error: tool call {tool_call.function.name} timed out after {timeout} seconds"
+        if span.enabled:
+            trace_result(span, result)
+    if journal:
+        journal.result(tool_call.id, result)
+    return result
+
 
+async def _acall_tool(tools, tool_call):
+    parameters = json.loads(tool_call.function.arguments)
+    function = tools.functions[tool_call.function.name]
+
+    # sync functions are run in a thread so they don't block the event loop
+    if inspect.iscoroutinefunction(function):
+        return await function(**parameters)
+    result = await asyncio.to_thread(function, **parameters)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def acall_batch(tools, batch, timeout=None, tracer=null_tracer, journal=None):
+    if len(batch) == 1:
+        return [await acall_tool(tools, batch[0], timeout, tracer, journal)]
+    try:
+        return await asyncio.wait_for(asyncio.to_thread(call_batch, tools, batch, tracer, journal), timeout)
+    except asyncio.TimeoutError:
+        return f"Error: tool call {batch[0].function.name} timed out after {timeout} seconds"
+
+
+async def acall_tools(tools, tool_calls, timeout=None, tracer=null_tracer, journal=None):
+    """Call each tool concurrently and return the results in the same order as tool_calls"""
+    batches = coalesce_tool_calls(tools, tool_calls)
+    results = await asyncio.gather(*(acall_batch(tools, batch, timeout, tracer, journal) for batch in batches))
+    return scatter_results(tool_calls, batches, results)
+
+
+# ANSI escape codes for the color of each role
+role_colors = {
+    'user': '\033[92m',  # Green
+    'system': '\033[90m', # Grey
+    'tool': '\033[94m',  # Blue
+    'assistant': '\033[93m',  # Yellow
+    'reset': '\033[0m'   # Reset
+}
+
+
+def format_message(message):
+    """Return the text printed for a message in verbose mode, without changing the message"""
     role = message['role']
+    content = message.get('content')
+    reset = role_colors['reset']
+    color = role_colors.get(role, '')
 
     # if role is not assistant, add a tab to align the messages
-    if role not in ('assistant','system'):
-        message['content'] = f"\t{message['content']}"
+    if role not in ('assistant', 'system'):
+        content = f"\t{content}"
 
     # add newlines after every 80 characters if role is user or assistant
-    if role in ['user', 'assistant'] and message['content']:
-        message['content'] = '\n'.join(
-            [message['content'][i:i+80] for i in range(0, len(message['content']), 80)])
+    if role in ['user', 'assistant'] and content:
+        content = '\n'.join([content[i:i+80] for i in range(0, len(content), 80)])
 
     # if message contains line breaks, insert 3 tabs to align the messages
-    if message['content'] and '\n' in message['content']:
-        message['content'] = message['content'].replace('\n', '\n\t\t')
+    if content and '\n' in content:
+        content = content.replace('\n', '\n\t\t')
 
-    color = role_colors.get(role, '')
-    if message['content'] and message['role'] != 'tool':
-        print(
-            f"{color}[{role}]{role_colors['reset']}\t{message['content']}{role_colors['reset']}")
-
-    elif message['content'] and message['role'] == 'tool':
-        if tool_calls_message:
-            # get tool_calls_message where tool_call_id matches the current message's tool_call_id
-            tool_call = next(
-                (tool_call for tool_call in tool_calls_message['tool_calls'] if tool_call['id'] == message['tool_call_id']), None)
-            print(f"{color}[{role}]{role_colors['reset']}\t\tOutput of tool call {tool_call['function']['name']}({tool_call['function']['arguments']})\n\t{message['content']}{role_colors['reset']}")
-        else:
-            print(
-                f"{color}[{role}]{role_colors['reset']}\t{message['content']}{role_colors['reset']}")
+    lines = []
+    if content:
+        lines.append(f"{color}[{role}]{reset}\t{content}{reset}")
 
-    elif message['tool_calls']:
-        print(f"{color}[{role}]{role_colors['reset']}\tCalling {len(message['tool_calls'])} tool{'s' if len(message['tool_calls']) > 1 else ''}:")
+    elif message.get('tool_calls'):
+        tool_calls = message['tool_calls']
+        lines.append(f"{color}[{role}]{reset}\tCalling {len(tool_calls)} tool{'s' if len(tool_calls) > 1 else ''}:")
 
-        for tool_call in message['tool_calls']:
-            # add tabs to tool_call['function']['arguments'] if it contains line breaks
-            tool_call['function']['arguments'] = tool_call['function']['arguments'].replace(
-                '\n', '\n\t\t')
+        for tool_call in tool_calls:
+            # add tabs to the arguments if they contain line breaks
+            arguments = tool_call['function']['arguments'].replace('\n', '\n\t\t')
+            lines.append(f"\t\t{tool_call['function']['name']}({arguments})")
 
-            print(
-                f"\t\t{tool_call['function']['name']}({tool_call['function']['arguments']})")
+    return '\n'.join(lines) + '\n\n' if lines else '\n'
 
-    print()
+
+def print_message(message):
+    """Print a message right away, see Renderer for printing in the background"""
+    print(format_message(message), end='')
+
+
+def snapshot_message(message):
+    # a copy of what is printed, so later changes to the message, e.g. by compaction, aren't shown
+    snapshot = {'role': message['role'], 'content': message.get('content')}
+    if message.get('tool_calls'):
+        snapshot['tool_calls'] = [
+            {'function': {'name': tool_call['function']['name'], 'arguments': tool_call['function']['arguments']}}
+            for tool_call in message['tool_calls']]
+    return snapshot
+
+
+class Renderer:
+    """Prints messages on a background thread, so verbose mode doesn't slow the agent down.
+    Messages are copied when they are rendered and formatted on the thread, and everything waiting is
+    written at once. When more than max_pending messages are waiting, the oldest are dropped and a line
+    says how many. Waiting messages are written before the program exits, or when flush is called"""
+
+    def __init__(self, stream=None, max_pending=1000):
+        self.stream = stream
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.dropped = 0
+        self.writing = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def render(self, message):
+        snapshot = snapshot_message(message)
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append(snapshot)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_forever, daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+            self.condition.notify_all()
+
+    __call__ = render
+
+    def write_forever(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                batch = list(self.pending)
+                self.pending.clear()
+                dropped, self.dropped = self.dropped, 0
+                self.writing = True
+
+            text = f"... {dropped} message{'s' if dropped > 1 else ''} not shown\n\n" if dropped else ""
+            text += ''.join(format_message(message) for message in batch)
+            # the stream is looked up each time, so redirecting stdout works
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(text)
+                stream.flush()
+            except (OSError, ValueError):
+                # stdout may have been closed
+                pass
+
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def flush(self, timeout=5):
+        """Wait up to timeout seconds until every rendered message has been written"""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending and not self.writing, timeout)
+
+
+# prints the messages of verbose agents
+default_renderer = Renderer()
+
+
+def render_message(message):
+    default_renderer.render(message)
 
 
 def running(messages, verbose=True) -> bool:
@@ -142,16 +713,20 @@ def running(messages, verbose=True) -> bool:
     # if verbose and type of messages is not .bases Messagesm, make messages = Messages(messages)
     if verbose:
         if not isinstance(messages, Messages):
-            messages = Messages(messages, verbose=True, print_fn=print_message)
+            messages = Messages(messages, verbose=True, print_fn=render_message)
             for message in messages:
                 messages.print_fn(message)
         else:
             messages.verbose = True
-            messages.print_fn = print_message
+            messages.print_fn = render_message
 
     if is_running:
+        if isinstance(messages, Messages):
+            messages.compact()
         return messages
     elif isinstance(messages, Messages) and messages.listeners:
+        # write the turn before a listener prompts for the next message, or the caller goes on
+        default_renderer.flush()
         if all(listener.exit_event.is_set() for listener in messages.listeners):
             messages.exit()
             return False
@@ -160,8 +735,10 @@ def running(messages, verbose=True) -> bool:
         # we need wait to listen for messages
         messages.clear_if_finished()
         messages.block_if_empty()
+        messages.compact()
         return messages
     else:
+        default_renderer.flush()
         return False
 
 
@@ -180,7 +757,35 @@ def import_tools(tool_names=[], include_self=True):
             ".Self", package=__package__)
         result.extend(tool_class())
 
-    return result
+    return ToolRegistry(result)
+
+
+@functools.lru_cache(maxsize=None)
+def check_dependency(package_spec):
+    """Check that an installed package satisfies a spec like 'slack_sdk>=3.31.0'.
+    Successful checks are memoized, so each package is only resolved once per process"""
+    try:
+        split_point = min([i for i in range(
+            len(package_spec)) if package_spec[i] in "><=!" and package_spec[i:i+2] != '!='])
+        package = package_spec[:split_point].strip()
+        specifiers = package_spec[split_point:].strip()
+
+        try:
+            version = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            raise ImportError(f"Package '{package}' is not installed. Please run 'pip install {package}{specifiers}'.")
+
+        from packaging.version import parse as parse_version
+        from packaging.specifiers import SpecifierSet
+
+        if not SpecifierSet(specifiers).contains(parse_version(version)):
+            raise ImportError(
+                f"Package '{package}' version must satisfy '{specifiers}'. Please run 'pip install \"{package}{specifiers}\"'.")
+    except ImportError:
+        raise
+    except Exception as e:
+        raise ImportError(f"Dependency check failed for '{package_spec}': {e}")
+    return True
 
 
 class LazyImport:
@@ -192,21 +797,7 @@ class LazyImport:
 
     def _check_dependencies(self):
         for package_spec in self.dependencies:
-            try:
-                split_point = min([i for i in range(
-                    len(package_spec)) if package_spec[i] in "><=!" and package_spec[i:i+2] != '!='])
-                package = package_spec[:split_point].strip()
-                specifiers = package_spec[split_point:].strip()
-
-                dist = pkg_resources.get_distribution(package)
-                spec_set = SpecifierSet(specifiers)
-                if not spec_set.contains(parse_version(dist.version)):
-                    raise ImportError(
-                        f"Package '{package}' version must satisfy '{specifiers}'. Please run 'pip install \"{package}{specifiers}\"'.")
-            except pkg_resources.DistributionNotFound:
-                raise ImportError(f"Package '{package}' is not installed. Please run 'pip install {package}{specifiers}'.")
-            except Exception as e:
-                raise ImportError(f"Dependency check failed for '{package_spec}': {e}")
+            check_dependency(package_spec)
         return True
 
     def _load_class(self):
@@ -228,72 +819,120 @@ class LazyImport:
 
 
 def method_to_json_schema(method):
+    from pydantic import create_model
+
     signature = inspect.signature(method)
     hints = get_type_hints(method)
     hints.pop('return', None)  # Remove return type hint if present
     hints.pop('self', None)  # Remove 'self' from type hints
-    model_fields = {name: (typ, ...) for name,
-                    typ in hints.items() if name in signature.parameters}
+    # parameters without a default value are required
+    model_fields = {name: (typ, signature.parameters[name].default
+                           if signature.parameters[name].default is not inspect.Parameter.empty else ...)
+                    for name, typ in hints.items() if name in signature.parameters}
     dynamic_model = create_model('DynamicModel', **model_fields)
     return dynamic_model.schema()
 
 
+# change this when method_to_json_schema changes, so cached schemas are rebuilt
+SCHEMA_CACHE_VERSION = 2
+
+
+def compile_function_schema(func):
+    """Validate func and return its function schema. If the INTO_SCHEMA_CACHE environment variable is set
+    to a directory, schemas are cached there, keyed by a hash of the function source"""
+    cache_dir = os.environ.get('INTO_SCHEMA_CACHE')
+    cache_path = None
+    if cache_dir:
+        cache_dir = os.path.expanduser(cache_dir)
+        try:
+            source = inspect.getsource(func)
+        except (OSError, TypeError):
+            source = None
+        if source:
+            key = hashlib.sha256(
+                f"{SCHEMA_CACHE_VERSION}\n{func.__module__}.{func.__qualname__}\n{source}".encode()).hexdigest()
+            cache_path = os.path.join(cache_dir, f"{key}.json")
+            try:
+                with open(cache_path) as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    # print the func parameters, type hints, and defaults
+    signature = inspect.signature(func)
+    func_parameters = signature.parameters
+
+    # check that the function has a docstring
+    if not func.__doc__:
+        raise ValueError(
+            f"Missing docstring for function {func.__name__} in {func.__module__}")
+
+    from docstring_parser import parse
+    docstring = parse(func.__doc__)
+    params = {param.arg_name: param for param in docstring.params}
+
+    # check that docstring has a description
+    if not docstring.description:
+        raise ValueError(
+            f"Missing description for function {func.__name__} in {func.__module__}")
+
+    # check that all parameters have a description
+    for parameter in func_parameters.values():
+        if parameter.name == 'self':
+            continue
+        if parameter.name not in params:
+            raise ValueError(
+                f"Missing description for parameter {parameter.name} in function {func.__name__}")
+
+    # check that all parameters have a type hint
+    for parameter in func_parameters.values():
+        if parameter.name == 'self':
+            continue
+        if parameter.annotation == inspect.Parameter.empty:
+            raise ValueError(
+                f"Missing type hint for parameter {parameter.name} in function {func.__name__}")
+
+    # generate JSON schema for the function parameters
+    parameters = method_to_json_schema(func)
+
+    # add descriptions from docstring to parameters
+    for parameter in parameters['properties']:
+        if parameter in params:
+            parameters['properties'][parameter]['description'] = params[parameter].description
+
+    schema = {
+        "name": func.__name__,
+        "description": docstring.description,
+        "parameters": parameters
+    }
+
+    if cache_path:
+        # write to a temporary file first so other processes never read a partial schema
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(schema, f)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass
+
+    return schema
+
+
 def callable_function(func):
 
     func._callable = True
 
+    # the schema is compiled once here, and never modified afterwards
+    func._schema = compile_function_schema(func)
+
     class CallableFunction(JSONSerializableFunction):
 
         def __init__(self, tool):
             super().__init__(tool)
             self['type'] = "function"
-
-            # print the func parameters, type hints, and defaults
-            signature = inspect.signature(func)
-            func_parameters = signature.parameters
-
-            # check that the function has a docstring
-            if not func.__doc__:
-                raise ValueError(
-                    f"Missing docstring for function {func.__name__} in {func.__module__}")
-
-            docstring = parse(func.__doc__)
-            params = {param.arg_name: param for param in docstring.params}
-
-            # check that docstring has a description
-            if not docstring.description:
-                raise ValueError(
-                    f"Missing description for function {func.__name__} in {func.__module__}")
-
-            # check that all parameters have a description
-            for parameter in func_parameters.values():
-                if parameter.name == 'self':
-                    continue
-                if parameter.name not in params:
-                    raise ValueError(
-                        f"Missing description for parameter {parameter.name} in function {func.__name__}")
-
-            # check that all parameters have a type hint
-            for parameter in func_parameters.values():
-                if parameter.name == 'self':
-                    continue
-                if parameter.annotation == inspect.Parameter.empty:
-                    raise ValueError(
-                        f"Missing type hint for parameter {parameter.name} in function {func.__name__}")
-
-            # generate JSON schema for the function parameters
-            parameters = method_to_json_schema(func)
-
-            # add descriptions from docstring to parameters
-            for parameter in parameters['properties']:
-                if parameter in params:
-                    parameters['properties'][parameter]['description'] = params[parameter].description
-
-            self['function'] = {
-                "name": func.__name__,
-                "description": docstring.description,
-                "parameters": parameters
-            }
+            self['function'] = copy.deepcopy(func._schema)
 
     # add func to the class with the same name
     setattr(CallableFunction, func.__name__, func)
@@ -302,6 +941,138 @@ def callable_function(func):
     return func
 
 
+def cache_scope(function_self):
+    # results are only shared between tools of the same class and token
+    tool = getattr(function_self, 'tool', function_self)
+    return (type(tool).__qualname__, getattr(tool, 'token', None))
+
+
+def bind_arguments(signature, args, kwargs):
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    # the first argument is the function's self
+    arguments.pop(next(iter(signature.parameters)), None)
+    return arguments
+
+
+def is_error(result):
+    return isinstance(result, str) and result.startswith('Error')
+
+
+def cacheable(ttl=300, max_entries=256, tags=(), cache_if=None):
+    """Cache the results of a read-only tool function for ttl seconds, keeping up to max_entries results.
+    Results are cached by the function's arguments, with defaults filled in, so f(a) and f(a, b=None)
+    share a result. Each of tags is formatted with the arguments, e.g. "records:{base_id}", and functions
+    decorated with invalidates(...) remove the results with matching tags.
+    Results for which cache_if(result) is False are not cached; by default errors are not cached.
+    Use it below @callable_function, or on the method of a JSONSerializableFunction"""
+    def decorator(func):
+        signature = inspect.signature(func)
+        cache = ToolCache(func.__qualname__, ttl=ttl, max_entries=max_entries)
+        should_cache = cache_if or (lambda result: not is_error(result))
+
+        def lookup(args, kwargs):
+            arguments = bind_arguments(signature, args, kwargs)
+            scope = cache_scope(args[0])
+            key = (scope, json.dumps(arguments, sort_keys=True, default=str))
+            return key, [(scope, tag.format(**arguments)) for tag in tags]
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                key, entry_tags = lookup(args, kwargs)
+                hit, result = cache.get(key)
+                if not hit:
+                    result = await func(*args, **kwargs)
+                    if should_cache(result):
+                        cache.set(key, result, entry_tags)
+                return result
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                key, entry_tags = lookup(args, kwargs)
+                hit, result = cache.get(key)
+                if not hit:
+                    result = func(*args, **kwargs)
+                    if should_cache(result):
+                        cache.set(key, result, entry_tags)
+                return result
+
+        wrapper.cache = cache
+        # used by cached_batch, for calls that are made together by a batch method
+        wrapper.cache_key = lambda function_self, kwargs: lookup((function_self,), kwargs)
+        wrapper.should_cache = should_cache
+        return wrapper
+    return decorator
+
+
+def cached_batch(function, function_self, batch_method, arguments):
+    """Return a result for each of arguments, the keyword arguments of calls of function. Results cached by
+    function, see cacheable, are used, batch_method is only called with the rest, and their results are cached"""
+    results = [None] * len(arguments)
+    misses = []
+    cache = getattr(function, 'cache', None)
+    for index, kwargs in enumerate(arguments):
+        key = entry_tags = None
+        if cache is not None:
+            try:
+                key, entry_tags = function.cache_key(function_self, kwargs)
+            except TypeError:
+                # arguments that function doesn't take can't be cached
+                key = None
+        hit, result = cache.get(key) if key is not None else (False, None)
+        if hit:
+            results[index] = result
+        else:
+            misses.append((index, key, entry_tags))
+
+    if misses:
+        batch_results = batch_method([arguments[index] for index, _, _ in misses])
+        for (index, key, entry_tags), result in zip(misses, batch_results):
+            results[index] = result
+            if key is not None and function.should_cache(result):
+                cache.set(key, result, entry_tags)
+    return results
+
+
+def invalidates(*tags):
+    """Remove the cached results with any of tags after the decorated function has run, see cacheable"""
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def invalidate(args, kwargs):
+            arguments = bind_arguments(signature, args, kwargs)
+            scope = cache_scope(args[0])
+            ToolCache.invalidate_all([(scope, tag.format(**arguments)) for tag in tags])
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    invalidate(args, kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    invalidate(args, kwargs)
+        return wrapper
+    return decorator
+
+
+def coalesce(batch_method):
+    """Mark a tool function whose calls in the same turn can be made together. batch_method is the name of
+    a method of the tool that takes a list of the calls' arguments and returns a result for each"""
+    def decorator(func):
+        func._coalesce = batch_method
+        return func
+    return decorator
+
+
 def tool_auth(*, token_env_name):
     def decorator(cls):
         cls.token_env_name = token_env_name
@@ -333,19 +1104,20 @@ def message_auth(required_env_vars):
     return decorator
 
 
-def read_messages(listener_names=[]):
+def read_messages(listener_names=[], weights=None):
+    """Create Messages filled by the named listeners, e.g. ['Slack', 'FastAPI'].
+    With several listeners, weights can give some of them more turns, e.g. {'Slack': 2}"""
     if not listener_names:
         raise ValueError("You must specify at least one listener")
 
-    if len(listener_names) > 1:
-        raise NotImplementedError("More than one listener is not yet supported")
-
+    weights = weights or {}
     try:
         listeners = []
         listener_module = importlib.import_module(f"{__package__}.messages")
         for listener_name in listener_names:
             listener_class = getattr(listener_module, listener_name)
             listener_instance = listener_class()
+            listener_instance.weight = weights.get(listener_name, listener_instance.weight)
             listeners.append(listener_instance)
 
         return Messages(listeners=listeners)